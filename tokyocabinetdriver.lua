@@ -0,0 +1,578 @@
+-- -----------------------------------------------------------------------
+-- Copyright (C) 2011
+-- Marcelo Martins
+-- http://www.cs.brown.edu/~martins/
+--
+-- Permission is hereby granted, free of charge, to any person obtaining
+-- a copy of this software and associated documentation files (the
+-- "Software"), to deal in the Software without restriction, including
+-- without limitation the rights to use, copy, modify, merge, publish,
+-- distribute, sublicense, and/or sell copies of the Software, and to
+-- permit persons to whom the Software is furnished to do so, subject to
+-- the following conditions:
+--
+-- The above copyright notice and this permission notice shall be
+-- included in all copies or substantial portions of the Software.
+--
+-- THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+-- EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+-- MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT
+-- IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+-- OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+-- ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+-- OTHER DEALINGS IN THE SOFTWARE.
+-- -----------------------------------------------------------------------
+
+-- Tokyo Tyrant extension functions used by the TPC-C Tokyo Cabinet driver.
+-- Every ttserver of the benchmark must be started with
+--
+--     ttserver -ext tokyocabinetdriver.lua ...
+--
+-- Table records are seen by the extension as their serialized form: column
+-- names and values separated by the zero character.
+
+SEP = "\0"
+
+---------------------------------------------------------------------------
+-- Helpers
+---------------------------------------------------------------------------
+
+-- Deserializes a table record into a Lua table
+function decode(value)
+   local cols = {}
+   local elems = _split(value)
+   for i = 1, #elems - 1, 2 do
+      cols[elems[i]] = elems[i+1]
+   end
+   return cols
+end
+
+-- Serializes a Lua table into a table record
+function encode(cols)
+   local elems = {}
+   for name, value in pairs(cols) do
+      table.insert(elems, name)
+      table.insert(elems, value)
+   end
+   return table.concat(elems, SEP)
+end
+
+-- Returns the key of the cold half of a row split by the driver's
+-- split_tables option (see HOT_COLUMNS)
+function coldkey(key)
+   return "COLD:" .. key
+end
+
+-- Returns the row stored under key as a Lua table, or nil if it does not
+-- exist. The halves of a split row are merged; they are also returned
+-- as separate tables, to be given back to putrow.
+function getrow(key)
+   local stored = _get(key)
+   if not stored then
+      return nil
+   end
+   local cols = decode(stored)
+   local cold = _get(coldkey(key))
+   if not cold then
+      return cols
+   end
+   local hotcols = decode(stored)
+   local coldcols = decode(cold)
+   for name, v in pairs(coldcols) do
+      cols[name] = v
+   end
+   return cols, hotcols, coldcols
+end
+
+-- Stores a row read by getrow. Each column of a split row goes back to
+-- its half; the cold half is only written if writecold is true.
+function putrow(key, cols, hotcols, coldcols, writecold)
+   if not coldcols then
+      return _put(key, encode(cols))
+   end
+   for name in pairs(hotcols) do
+      hotcols[name] = cols[name]
+   end
+   local ok = _put(key, encode(hotcols))
+   if writecold then
+      for name in pairs(coldcols) do
+         coldcols[name] = cols[name]
+      end
+      ok = _put(coldkey(key), encode(coldcols)) and ok
+   end
+   return ok
+end
+
+---------------------------------------------------------------------------
+-- putcols
+---------------------------------------------------------------------------
+
+-- Merges columns into existing records, so clients only ship the columns
+-- they changed. key holds one or more primary keys separated by the zero
+-- character and value the columns to write, serialized as a table record.
+-- Returns the number of records updated, or nil if any of them does not
+-- exist.
+function putcols(key, value)
+   local changes = decode(value)
+   local keys = _split(key)
+   for i = 1, #keys do
+      local stored = _get(keys[i])
+      if not stored then
+         return nil
+      end
+      local cols = decode(stored)
+      for name, v in pairs(changes) do
+         cols[name] = v
+      end
+      if not _put(keys[i], encode(cols)) then
+         return nil
+      end
+   end
+   return tostring(#keys)
+end
+
+---------------------------------------------------------------------------
+-- addcols
+---------------------------------------------------------------------------
+
+-- Adds to numeric columns of existing records. key holds one or more
+-- primary keys separated by the zero character. value holds the number n
+-- of columns, their names and then n increments per key, all separated
+-- by the zero character. Returns the number of records updated, or nil
+-- if any of them does not exist.
+function addcols(key, value)
+   local keys = _split(key)
+   local args = _split(value)
+   local n = tonumber(args[1])
+   for i = 1, #keys do
+      local stored = _get(keys[i])
+      if not stored then
+         return nil
+      end
+      local cols = decode(stored)
+      for j = 1, n do
+         local name = args[1 + j]
+         cols[name] = tonumber(cols[name]) + tonumber(args[1 + n + (i-1)*n + j])
+      end
+      if not _put(keys[i], encode(cols)) then
+         return nil
+      end
+   end
+   return tostring(#keys)
+end
+
+---------------------------------------------------------------------------
+-- popqueues
+---------------------------------------------------------------------------
+
+-- Removes the oldest record of a queue and returns its id, or nil if the
+-- queue is empty. head is the key of the queue's head counter,
+-- "<column>:<rest>", holding the id of its oldest record, whose key is
+-- "<id>:<rest>". The queue stops at a missing record, whose writer may
+-- still be running, unless an "ABORTED:<id>:<rest>" record marks the id
+-- as given up: markers are removed and skipped.
+function pop(head)
+   local rest = string.match(head, "^[^:]*:(.*)$")
+   local first = _addint(head, 0)
+   local id = first
+   local popped = nil
+   while true do
+      if _out(id .. ":" .. rest) then
+         _out("ABORTED:" .. id .. ":" .. rest)
+         popped = id
+         id = id + 1
+         break
+      end
+      if not _out("ABORTED:" .. id .. ":" .. rest) then
+         break
+      end
+      id = id + 1
+   end
+   if id > first then
+      _addint(head, id - first)
+   end
+   return popped
+end
+
+-- Pops several queues at once. key holds their head counter keys
+-- separated by the zero character. Returns the popped ids in the same
+-- order, with empty strings for empty queues. Must be called with the
+-- global lock.
+function popqueues(key, value)
+   local result = {}
+   local keys = _split(key)
+   for i = 1, #keys do
+      table.insert(result, pop(keys[i]) or "")
+   end
+   return table.concat(result, SEP)
+end
+
+-- Removes the first record of several key ranges of a B+tree database,
+-- the queues of the driver's ordered_tables option. key holds the begin
+-- (included) and end (excluded) key of each range, separated by the zero
+-- character. Returns the removed keys in the same order, with empty
+-- strings for empty ranges. Must be called with the global lock.
+function popranges(key, value)
+   local result = {}
+   local bounds = _split(key)
+   for i = 1, #bounds - 1, 2 do
+      local first = _misc("range", { bounds[i], bounds[i+1], "1" }) or {}
+      if #first > 0 and _out(first[1]) then
+         table.insert(result, first[1])
+      else
+         table.insert(result, "")
+      end
+   end
+   return table.concat(result, SEP)
+end
+
+---------------------------------------------------------------------------
+-- Aggregates
+---------------------------------------------------------------------------
+
+-- Aggregates compute over the records with the given keys on the server,
+-- so only their results travel to the client. key holds the primary keys
+-- separated by the zero character; missing records are skipped. value
+-- holds the column name followed by the function's arguments.
+
+-- Returns the values of a column in the existing records
+function values(keys, column)
+   local result = {}
+   for i = 1, #keys do
+      local stored = _get(keys[i])
+      if stored then
+         table.insert(result, decode(stored)[column])
+      end
+   end
+   return result
+end
+
+-- Sums the column over consecutive groups of keys. The arguments are the
+-- group sizes. Returns one sum per group.
+function sumcols(key, value)
+   local result = {}
+   local keys = _split(key)
+   local args = _split(value)
+   local first = 1
+   for i = 2, #args do
+      local group = {}
+      for j = first, first + tonumber(args[i]) - 1 do
+         table.insert(group, keys[j])
+      end
+      first = first + tonumber(args[i])
+      local total = 0
+      local vals = values(group, args[1])
+      for j = 1, #vals do
+         total = total + tonumber(vals[j])
+      end
+      table.insert(result, total)
+   end
+   return table.concat(result, SEP)
+end
+
+-- Counts the records. With arguments, an operator (lt, le, eq, ge, gt) and
+-- a number, only counts the ones whose column compares to the number.
+function countcols(key, value)
+   local args = _split(value)
+   local vals = values(_split(key), args[1])
+   if #args == 1 then
+      return tostring(#vals)
+   end
+   local count = 0
+   local operand = tonumber(args[3])
+   for i = 1, #vals do
+      local v = tonumber(vals[i])
+      if (args[2] == "lt" and v < operand) or (args[2] == "le" and v <= operand) or
+         (args[2] == "eq" and v == operand) or (args[2] == "ge" and v >= operand) or
+         (args[2] == "gt" and v > operand) then
+         count = count + 1
+      end
+   end
+   return tostring(count)
+end
+
+-- Returns the distinct values of the column
+function distinctcols(key, value)
+   local seen = {}
+   local result = {}
+   local vals = values(_split(key), value)
+   for i = 1, #vals do
+      if not seen[vals[i]] then
+         seen[vals[i]] = true
+         table.insert(result, vals[i])
+      end
+   end
+   return table.concat(result, SEP)
+end
+
+-- Runs an aggregate over the records of a key range of a B+tree database
+-- instead of a list of keys. key holds the begin (included) and end
+-- (excluded) keys and the aggregate's name, value its usual value.
+function rangecols(key, value)
+   local args = _split(key)
+   local range = _misc("range", { args[1], args[2] }) or {}
+   local keys = {}
+   for i = 1, #range - 1, 2 do
+      table.insert(keys, range[i])
+   end
+   return _G[args[3]](table.concat(keys, SEP), value)
+end
+
+---------------------------------------------------------------------------
+-- Transaction procedures
+---------------------------------------------------------------------------
+
+-- Each ttserver holds a single table, so every TPC-C transaction is split
+-- into one procedure per table it touches. The driver builds all primary
+-- and counter keys (see tupleToString and counterKey) and passes them in
+-- key, separated by the zero character; value carries the parameters.
+-- Results are returned as zero-separated lists or serialized records.
+
+-- Returns the primary key of an order. With ordered set to "1" it is the
+-- fixed-width key of the driver's ordered_tables option (see KeyCodec).
+function orderkey(w_id, d_id, o_id, ordered)
+   if ordered == "1" then
+      return string.format("%04x%02x%06x", w_id, d_id, o_id)
+   end
+   return table.concat({ o_id, d_id, w_id }, ":")
+end
+
+-- Splits a list argument. Returns an empty table for the empty string.
+function split(value)
+   if value == "" then
+      return {}
+   end
+   return _split(value)
+end
+
+-- Returns the customer record selected by primary key or, if key is
+-- empty, the midpoint customer (ordered by C_FIRST) with the given last
+-- name, taken from the district's C_LAST list. The other return values
+-- are the record's primary key and the halves of a split row (see
+-- getrow).
+function findcustomer(key, w_id, d_id, c_last)
+   if key == "" then
+      local index = _get(table.concat({ "C_LAST", w_id, d_id, c_last }, ":"))
+      if not index then
+         return nil
+      end
+      local c_ids = _split(decode(index)["C_IDS"], " ")
+      local c_id = c_ids[math.floor((#c_ids - 1) / 2) + 1]
+      key = table.concat({ c_id, d_id, w_id }, ":")
+   end
+   local cols, hotcols, coldcols = getrow(key)
+   if not cols then
+      return nil
+   end
+   return cols, key, hotcols, coldcols
+end
+
+-- DELIVERY, NEW_ORDER part. key: w_id, value: number of districts.
+-- Removes the oldest new order of every district, the one under the head
+-- of the district's queue (its NO_O_ID counter), advances the head and
+-- returns the (d_id, o_id) pairs of the districts that had one.
+function delivery_neworders(key, value)
+   local result = {}
+   for d_id = 1, tonumber(value) do
+      local o_id = pop(table.concat({ "NO_O_ID", d_id, key }, ":"))
+      if o_id then
+         table.insert(result, d_id)
+         table.insert(result, o_id)
+      end
+   end
+   return table.concat(result, SEP)
+end
+
+-- DELIVERY, ORDERS part. key: order keys, value: o_carrier_id.
+-- Sets the carrier of every order and returns their (O_C_ID, O_OL_CNT).
+function delivery_orders(key, value)
+   local result = {}
+   local keys = split(key)
+   for i = 1, #keys do
+      local cols = decode(_get(keys[i]))
+      cols["O_CARRIER_ID"] = value
+      _put(keys[i], encode(cols))
+      table.insert(result, cols["O_C_ID"])
+      table.insert(result, cols["O_OL_CNT"])
+   end
+   return table.concat(result, SEP)
+end
+
+-- DELIVERY, ORDER_LINE part. key: order line keys of all orders, value:
+-- ol_delivery_d followed by the number of lines of each order. Sets the
+-- delivery date of every line and returns SUM(OL_AMOUNT) of each order.
+function delivery_orderlines(key, value)
+   local result = {}
+   local keys = split(key)
+   local args = split(value)
+   local first = 1
+   for i = 2, #args do
+      local total = 0
+      for j = first, first + tonumber(args[i]) - 1 do
+         local stored = _get(keys[j])
+         if stored then
+            local cols = decode(stored)
+            cols["OL_DELIVERY_D"] = args[1]
+            _put(keys[j], encode(cols))
+            total = total + tonumber(cols["OL_AMOUNT"])
+         end
+      end
+      first = first + tonumber(args[i])
+      table.insert(result, total)
+   end
+   return table.concat(result, SEP)
+end
+
+-- DELIVERY, CUSTOMER part. key: customer keys, value: the amount to add
+-- to each customer's balance. Also counts the customer's deliveries.
+function delivery_customers(key, value)
+   local keys = split(key)
+   local amounts = split(value)
+   for i = 1, #keys do
+      local cols = decode(_get(keys[i]))
+      cols["C_BALANCE"] = tonumber(cols["C_BALANCE"]) + tonumber(amounts[i])
+      cols["C_DELIVERY_CNT"] = tonumber(cols["C_DELIVERY_CNT"]) + 1
+      _put(keys[i], encode(cols))
+   end
+   return tostring(#keys)
+end
+
+-- NEW_ORDER, DISTRICT part. key: district key, value: its D_NEXT_O_ID
+-- counter key. Returns D_TAX and the order id assigned to the new order.
+function neworder_district(key, value)
+   local cols = decode(_get(key))
+   local o_id = _addint(value, 1) - 1
+   return table.concat({ cols["D_TAX"], o_id }, SEP)
+end
+
+-- NEW_ORDER, STOCK part. key: stock keys, value: the S_DIST_xx column
+-- name, the home w_id and an (ol_supply_w_id, ol_quantity) pair per key.
+-- Updates the stock of every item and returns its (S_QUANTITY, S_DATA,
+-- S_DIST_xx). Missing stock records return empty values.
+function neworder_stock(key, value)
+   local result = {}
+   local keys = split(key)
+   local args = split(value)
+   for i = 1, #keys do
+      local supply_w_id = args[2*i + 1]
+      local quantity = tonumber(args[2*i + 2])
+      local cols, hotcols, coldcols = getrow(keys[i])
+      if cols then
+         local s_quantity = tonumber(cols["S_QUANTITY"])
+         if s_quantity >= quantity + 10 then
+            s_quantity = s_quantity - quantity
+         else
+            s_quantity = s_quantity + 91 - quantity
+         end
+         cols["S_QUANTITY"] = s_quantity
+         cols["S_YTD"] = tonumber(cols["S_YTD"]) + quantity
+         cols["S_ORDER_CNT"] = tonumber(cols["S_ORDER_CNT"]) + 1
+         if supply_w_id ~= args[2] then
+            cols["S_REMOTE_CNT"] = tonumber(cols["S_REMOTE_CNT"]) + 1
+         end
+         putrow(keys[i], cols, hotcols, coldcols, false)
+         table.insert(result, s_quantity)
+         table.insert(result, cols["S_DATA"])
+         table.insert(result, cols[args[1]])
+      else
+         table.insert(result, "")
+         table.insert(result, "")
+         table.insert(result, "")
+      end
+   end
+   return table.concat(result, SEP)
+end
+
+-- PAYMENT, WAREHOUSE and DISTRICT parts. key: row key, value: its YTD
+-- counter key and h_amount. Adds the payment to the counter and returns
+-- the row.
+function payment_ytd(key, value)
+   local args = split(value)
+   _adddouble(args[1], tonumber(args[2]))
+   return _get(key)
+end
+
+-- PAYMENT, CUSTOMER part. key: customer key, or empty to select the
+-- customer by last name. value: c_w_id, c_d_id, c_last, h_amount, w_id,
+-- d_id, the bad credit marker and the maximum C_DATA length. Applies the
+-- payment and returns the updated customer record.
+function payment_customer(key, value)
+   local args = split(value)
+   local cols, c_key, hotcols, coldcols = findcustomer(key, args[1], args[2], args[3])
+   if not cols then
+      return nil
+   end
+   local h_amount = tonumber(args[4])
+   cols["C_BALANCE"] = tonumber(cols["C_BALANCE"]) - h_amount
+   cols["C_YTD_PAYMENT"] = tonumber(cols["C_YTD_PAYMENT"]) + h_amount
+   cols["C_PAYMENT_CNT"] = tonumber(cols["C_PAYMENT_CNT"]) + 1
+   if cols["C_CREDIT"] == args[7] then
+      local data = table.concat({ cols["C_ID"], args[2], args[1], args[6], args[5], args[4] }, " ")
+      cols["C_DATA"] = string.sub(data .. "|" .. cols["C_DATA"], 1, tonumber(args[8]))
+   end
+   putrow(c_key, cols, hotcols, coldcols, cols["C_CREDIT"] == args[7])
+   return encode(cols)
+end
+
+-- ORDER_STATUS, CUSTOMER part. key: customer key, or empty to select the
+-- customer by last name. value: w_id, d_id, c_last. Returns the customer.
+function orderstatus_customer(key, value)
+   local args = split(value)
+   local cols = findcustomer(key, args[1], args[2], args[3])
+   if not cols then
+      return nil
+   end
+   return encode(cols)
+end
+
+-- ORDER_STATUS, ORDERS part. value: w_id, d_id, c_id and whether the
+-- table uses ordered keys (see orderkey). Returns the customer's most
+-- recent order, found through its last order pointer, or the empty string
+-- if there is none.
+function orderstatus_order(key, value)
+   local args = split(value)
+   local last = _get(table.concat({ "O_C_ID", args[1], args[2], args[3] }, ":"))
+   if not last then
+      return ""
+   end
+   local order = _get(orderkey(args[1], args[2], decode(last)["O_ID"], args[4]))
+   return order or ""
+end
+
+-- STOCK_LEVEL, ORDER_LINE part. value: w_id, d_id, the first and last
+-- order id and the maximum number of lines of an order. Probes the keys
+-- of all possible lines of those orders, like the client does, and
+-- returns their distinct OL_I_IDs.
+function stocklevel_items(key, value)
+   local args = split(value)
+   local seen = {}
+   local result = {}
+   for o_id = tonumber(args[3]), tonumber(args[4]) do
+      for ol_number = 1, tonumber(args[5]) do
+         local stored = _get(table.concat({ o_id, args[2], args[1], ol_number }, ":"))
+         if stored then
+            local i_id = decode(stored)["OL_I_ID"]
+            if not seen[i_id] then
+               seen[i_id] = true
+               table.insert(result, i_id)
+            end
+         end
+      end
+   end
+   return table.concat(result, SEP)
+end
+
+-- STOCK_LEVEL, STOCK part. key: stock keys, value: the threshold.
+-- Returns the number of those items whose S_QUANTITY is below it.
+function stocklevel_count(key, value)
+   local count = 0
+   local keys = split(key)
+   local threshold = tonumber(value)
+   for i = 1, #keys do
+      local stored = _get(keys[i])
+      if stored and tonumber(decode(stored)["S_QUANTITY"]) < threshold then
+         count = count + 1
+      end
+   end
+   return tostring(count)
+end
@@ -26,14 +26,29 @@
 
 from __future__ import with_statement
 from abstractdriver import *
+from multiprocessing.pool import ThreadPool
 from pprint import pprint, pformat
 from pyrant import protocol
+from threading import Condition, Lock, local
 
+import bisect
 import constants
+import hashlib
 import logging
 import os
 import pyrant
+import random
+import socket
+import string
 import sys
+import time
+import zlib
+
+## Tokyo Cabinet bindings are only needed by the embedded engine
+try:
+	from tokyocabinet import table as tctable
+except ImportError:
+	tctable = None
 
 TABLE_COLUMNS = {
 	constants.TABLENAME_ITEM: [
@@ -47,7 +62,7 @@ TABLE_COLUMNS = {
 		"W_ID", # SMALLINT
 		"W_NAME", # VARCHAR
 		"W_STREET_1", # VARCHAR
-		"W_STREEET_2", # VARCHAR
+		"W_STREET_2", # VARCHAR
 		"W_CITY", # VARCHAR
 		"W_STATE", # VARCHAR
 		"W_ZIP", # VARCHAR
@@ -114,7 +129,7 @@ TABLE_COLUMNS = {
 		"O_C_ID", # INTEGER
 		"O_D_ID", # TINYINT
 		"O_W_ID", # SMALLINT
-		"O_ENTRY_ID", # TIMESTAMP
+		"O_ENTRY_D", # TIMESTAMP
 		"O_CARRIER_ID", # INTEGER
 		"O_OL_CNT", # INTEGER
 		"O_ALL_LOCAL", # INTEGER
@@ -142,12 +157,158 @@ TABLE_COLUMNS = {
 		"H_C_W_ID", # SMALLINT
 		"H_D_ID", # TINYINT
 		"H_W_ID", # SMALLINT
-		"H_DATA", # TIMESTAMP
+		"H_DATE", # TIMESTAMP
 		"H_AMOUNT", # FLOAT
 		"H_DATA", # VARCHAR
 	],
 }
+## SQL type of every column, as noted in TABLE_COLUMNS
+COLUMN_TYPES = {
+	"I_ID": "INTEGER",
+	"I_IM_ID": "INTEGER",
+	"I_NAME": "VARCHAR",
+	"I_PRICE": "FLOAT",
+	"I_DATA": "VARCHAR",
+
+	"W_ID": "SMALLINT",
+	"W_NAME": "VARCHAR",
+	"W_STREET_1": "VARCHAR",
+	"W_STREET_2": "VARCHAR",
+	"W_CITY": "VARCHAR",
+	"W_STATE": "VARCHAR",
+	"W_ZIP": "VARCHAR",
+	"W_TAX": "FLOAT",
+	"W_YTD": "FLOAT",
+
+	"D_ID": "TINYINT",
+	"D_W_ID": "SMALLINT",
+	"D_NAME": "VARCHAR",
+	"D_STREET_1": "VARCHAR",
+	"D_STREET_2": "VARCHAR",
+	"D_CITY": "VARCHAR",
+	"D_STATE": "VARCHAR",
+	"D_ZIP": "VARCHAR",
+	"D_TAX": "FLOAT",
+	"D_YTD": "FLOAT",
+	"D_NEXT_O_ID": "INT",
+
+	"C_ID": "INTEGER",
+	"C_D_ID": "TINYINT",
+	"C_W_ID": "SMALLINT",
+	"C_FIRST": "VARCHAR",
+	"C_MIDDLE": "VARCHAR",
+	"C_LAST": "VARCHAR",
+	"C_STREET_1": "VARCHAR",
+	"C_STREET_2": "VARCHAR",
+	"C_CITY": "VARCHAR",
+	"C_STATE": "VARCHAR",
+	"C_ZIP": "VARCHAR",
+	"C_PHONE": "VARCHAR",
+	"C_SINCE": "TIMESTAMP",
+	"C_CREDIT": "VARCHAR",
+	"C_CREDIT_LIM": "FLOAT",
+	"C_DISCOUNT": "FLOAT",
+	"C_BALANCE": "FLOAT",
+	"C_YTD_PAYMENT": "FLOAT",
+	"C_PAYMENT_CNT": "INTEGER",
+	"C_DELIVERY_CNT": "INTEGER",
+	"C_DATA": "VARCHAR",
+
+	"S_I_ID": "INTEGER",
+	"S_W_ID": "SMALLINT",
+	"S_QUANTITY": "INTEGER",
+	"S_DIST_01": "VARCHAR",
+	"S_DIST_02": "VARCHAR",
+	"S_DIST_03": "VARCHAR",
+	"S_DIST_04": "VARCHAR",
+	"S_DIST_05": "VARCHAR",
+	"S_DIST_06": "VARCHAR",
+	"S_DIST_07": "VARCHAR",
+	"S_DIST_08": "VARCHAR",
+	"S_DIST_09": "VARCHAR",
+	"S_DIST_10": "VARCHAR",
+	"S_YTD": "INTEGER",
+	"S_ORDER_CNT": "INTEGER",
+	"S_REMOTE_CNT": "INTEGER",
+	"S_DATA": "VARCHAR",
+
+	"O_ID": "INTEGER",
+	"O_C_ID": "INTEGER",
+	"O_D_ID": "TINYINT",
+	"O_W_ID": "SMALLINT",
+	"O_ENTRY_D": "TIMESTAMP",
+	"O_CARRIER_ID": "INTEGER",
+	"O_OL_CNT": "INTEGER",
+	"O_ALL_LOCAL": "INTEGER",
+
+	"NO_O_ID": "INTEGER",
+	"NO_D_ID": "TINYINT",
+	"NO_W_ID": "SMALLINT",
+
+	"OL_O_ID": "INTEGER",
+	"OL_D_ID": "TINYINT",
+	"OL_W_ID": "SMALLINT",
+	"OL_NUMBER": "INTEGER",
+	"OL_I_ID": "INTEGER",
+	"OL_SUPPLY_W_ID": "SMALLINT",
+	"OL_DELIVERY_D": "TIMESTAMP",
+	"OL_QUANTITY": "INTEGER",
+	"OL_AMOUNT": "FLOAT",
+	"OL_DIST_INFO": "VARCHAR",
+
+	"H_C_ID": "INTEGER",
+	"H_C_D_ID": "TINYINT",
+	"H_C_W_ID": "SMALLINT",
+	"H_D_ID": "TINYINT",
+	"H_W_ID": "SMALLINT",
+	"H_DATE": "TIMESTAMP",
+	"H_AMOUNT": "FLOAT",
+	"H_DATA": "VARCHAR",
+}
+## Tokyo Cabinet index type for each SQL type
+INDEX_TYPES = {
+	"TINYINT": "decimal",
+	"SMALLINT": "decimal",
+	"INT": "decimal",
+	"INTEGER": "decimal",
+	"FLOAT": "decimal",
+	"TIMESTAMP": "lexical",
+	"VARCHAR": "lexical",
+}
+## Column indexes built after loading. Rows are read by key (see
+## recordKey), so transactions search no table. Moving a warehouse (see
+## warehouseKeys) searches each table on its partition column: these
+## indexes keep it from scanning the whole table
 TABLE_INDEXES = {
+	constants.TABLENAME_WAREHOUSE: [
+		"W_ID",
+	],
+	constants.TABLENAME_DISTRICT: [
+		"D_W_ID",
+	],
+	constants.TABLENAME_CUSTOMER: [
+		"C_W_ID",
+	],
+	constants.TABLENAME_STOCK: [
+		"S_W_ID",
+	],
+	constants.TABLENAME_ORDERS: [
+		"O_W_ID",
+	],
+	constants.TABLENAME_NEW_ORDER: [
+		"NO_W_ID",
+	],
+	constants.TABLENAME_ORDER_LINE: [
+		"OL_W_ID",
+	],
+	constants.TABLENAME_HISTORY: [
+		"H_W_ID",
+	],
+}
+## Primary key of each table. Records are stored under the tupleToString()
+## of these columns (see recordKey), so single rows can be fetched directly
+## by key
+TABLE_KEYS = {
 	constants.TABLENAME_ITEM: [
 		"I_ID",
 	],
@@ -171,7 +332,6 @@ TABLE_INDEXES = {
 		"O_ID",
 		"O_D_ID",
 		"O_W_ID",
-		"O_C_ID",
 	],
 	constants.TABLENAME_NEW_ORDER: [
 		"NO_O_ID",
@@ -182,9 +342,828 @@ TABLE_INDEXES = {
 		"OL_O_ID",
 		"OL_D_ID",
 		"OL_W_ID",
+		"OL_NUMBER",
+	],
+	constants.TABLENAME_HISTORY: [
+		"H_C_ID",
+		"H_C_D_ID",
+		"H_C_W_ID",
+	],
+}
+## Column holding the warehouse ID each table is partitioned on. ITEM has
+## no warehouse and is replicated to every server
+TABLE_PARTITION_COLUMNS = {
+	constants.TABLENAME_ITEM: None,
+	constants.TABLENAME_WAREHOUSE: "W_ID",
+	constants.TABLENAME_DISTRICT: "D_W_ID",
+	constants.TABLENAME_CUSTOMER: "C_W_ID",
+	constants.TABLENAME_STOCK: "S_W_ID",
+	constants.TABLENAME_ORDERS: "O_W_ID",
+	constants.TABLENAME_NEW_ORDER: "NO_W_ID",
+	constants.TABLENAME_ORDER_LINE: "OL_W_ID",
+	constants.TABLENAME_HISTORY: "H_W_ID",
+}
+## SERVER value of a warehouse that is being moved (see refreshPartitionMap)
+PARTITION_MOVING = -1
+## Hot counter columns. They are not stored in their row but in dedicated
+## counter records (see counterKey), which Tyrant updates atomically with
+## addint/adddouble and which return the new value in the same round trip
+TABLE_COUNTERS = {
+	constants.TABLENAME_WAREHOUSE: [
+		"W_YTD",
+	],
+	constants.TABLENAME_DISTRICT: [
+		"D_YTD",
+		"D_NEXT_O_ID",
 	],
 }
 
+## With ordered_tables these tables are kept in B+tree databases, under
+## keys made of the listed columns, in this order, each written as a fixed
+## number of hex digits (see KeyCodec). Keys then sort like the numbers
+## they hold, and the rows of a warehouse, district or order are a
+## contiguous key range
+ORDERED_KEYS = {
+	constants.TABLENAME_ORDERS: [("O_W_ID", 4), ("O_D_ID", 2), ("O_ID", 6)],
+	constants.TABLENAME_NEW_ORDER: [("NO_W_ID", 4), ("NO_D_ID", 2), ("NO_O_ID", 6)],
+	constants.TABLENAME_ORDER_LINE: [("OL_W_ID", 4), ("OL_D_ID", 2), ("OL_O_ID", 6), ("OL_NUMBER", 2)],
+}
+
+class KeyCodec(object):
+	"""Fixed-width, order-preserving keys of one of the ORDERED_KEYS
+	   tables. Hex digits keep the keys printable, as they travel in
+	   zero-separated lists to tokyocabinetdriver.lua"""
+
+	def __init__(self, tableName):
+		columns = ORDERED_KEYS[tableName]
+		self.positions = [TABLE_KEYS[tableName].index(c) for c, width in columns]
+		self.widths = [width for c, width in columns]
+		self.format = "".join("%%0%dx" % width for width in self.widths)
+
+	def encode(self, key):
+		"""Encodes a primary key tuple, in TABLE_KEYS order"""
+		return self.format % tuple([int(key[i]) for i in self.positions])
+
+	def prefix(self, *values):
+		"""Encodes the first key columns, in ORDERED_KEYS order. The keys
+		   starting with these values sort between prefix(*values) and
+		   the prefix of the next value of the last column"""
+		return "".join("%0*x" % (width, int(v)) for width, v in zip(self.widths, values))
+
+	def decode(self, string):
+		"""Returns the primary key tuple, in TABLE_KEYS order"""
+		key = [None] * len(self.positions)
+		offset = 0
+		for i, width in zip(self.positions, self.widths):
+			key[i] = int(string[offset:offset+width], 16)
+			offset += width
+		## FOR
+		return tuple(key)
+
+## With split_tables the rows of these tables are stored as two records
+## in their table: a hot one, under the row's key, with the key and the
+## listed columns, which transactions update, and a cold one (see coldKey)
+## with the key and the remaining, descriptive columns. The hot records are
+## small enough for Tyrant's record cache to hold the working set
+HOT_COLUMNS = {
+	constants.TABLENAME_CUSTOMER: [
+		"C_ID",
+		"C_D_ID",
+		"C_W_ID",
+		"C_BALANCE",
+		"C_YTD_PAYMENT",
+		"C_PAYMENT_CNT",
+		"C_DELIVERY_CNT",
+	],
+	constants.TABLENAME_STOCK: [
+		"S_I_ID",
+		"S_W_ID",
+		"S_QUANTITY",
+		"S_YTD",
+		"S_ORDER_CNT",
+		"S_REMOTE_CNT",
+	],
+}
+
+## ==============================================
+## Typed records
+## ==============================================
+
+## Python type of each column type (see COLUMN_TYPES). Strings and
+## timestamps are kept as they are stored
+TYPE_DECODERS = {
+	"TINYINT": int,
+	"SMALLINT": int,
+	"INT": int,
+	"INTEGER": int,
+	"FLOAT": float,
+	"VARCHAR": None,
+	"TIMESTAMP": None,
+}
+
+class Record(object):
+	"""Base class of the typed rows built by RecordCodec. Columns are
+	   slots, which can also be read and written as record["COLUMN"], so
+	   records stand in for column dictionaries. Columns that were not
+	   stored are None"""
+	__slots__ = ( )
+
+	def __init__(self, values):
+		for name, value in zip(self.__slots__, values):
+			setattr(self, name, value)
+
+	def __getitem__(self, name):
+		return getattr(self, name)
+
+	def __setitem__(self, name, value):
+		setattr(self, name, value)
+
+	def update(self, cols):
+		for name, value in cols.iteritems():
+			setattr(self, name, value)
+
+	def copy(self):
+		return self.__class__([getattr(self, name) for name in self.__slots__])
+
+	def iteritems(self):
+		"""Iterates over the (column, value) pairs of the columns that are
+		   not None"""
+		for name in self.__slots__:
+			value = getattr(self, name)
+			if value != None:
+				yield name, value
+		## FOR
+
+	def __repr__(self):
+		return "%s(%s)" % (self.__class__.__name__, ", ".join("%s=%r" % item for item in self.iteritems()))
+
+class RecordCodec(object):
+	"""Decodes the serialized rows of one table into Record objects with
+	   typed values, and encodes them back for multi_set. Columns of other
+	   tables, like the "_num" of counter records, are ignored. The given
+	   compressed columns go through a ColumnCompressor"""
+
+	def __init__(self, tableName, compressed=( ), compressor=None):
+		self.columns = TABLE_COLUMNS[tableName]
+		self.positions = dict((name, i) for i, name in enumerate(self.columns))
+		self.decoders = [TYPE_DECODERS[COLUMN_TYPES[name]] for name in self.columns]
+		self.encoders = dict()
+		for name in compressed:
+			if name in self.positions:
+				self.decoders[self.positions[name]] = compressor.decompress
+				self.encoders[name] = compressor.compress
+		## FOR
+		self.record = type("%sRecord" % tableName.title().replace("_", ""), (Record, ), {"__slots__": tuple(self.columns)})
+
+	def decode(self, value):
+		values = [None] * len(self.columns)
+		elems = value.split(protocol.TABLE_COLUMN_SEP)
+		for name, v in zip(elems[::2], elems[1::2]):
+			i = self.positions.get(name)
+			if i != None:
+				decoder = self.decoders[i]
+				values[i] = decoder(v) if decoder != None else v
+		## FOR
+		return self.record(values)
+
+	def encode(self, record, columns=None):
+		"""Returns the columns of a record that are set, or only the given
+		   ones, as strings"""
+		if columns != None:
+			return dict((name, self.encodeValue(name, value)) for name, value in record.iteritems() if name in columns)
+		return dict((name, self.encodeValue(name, value)) for name, value in record.iteritems())
+
+	def encodeValue(self, name, value):
+		encoder = self.encoders.get(name)
+		if encoder != None:
+			return encoder(str(value))
+		return str(value)
+
+## ==============================================
+## Column compression
+## ==============================================
+
+## Size of the preset dictionary, and length of the substrings it is built
+## from (see trainDictionary)
+DICTIONARY_SIZE = 4096
+DICTIONARY_GRAM = 5
+## Number of generated rows the dictionary is trained on
+DICTIONARY_SAMPLES = 1000
+
+def sampleColumns(count, seed=0):
+	"""Generates values like the ones the TPC-C loader writes to C_DATA,
+	   S_DATA and I_DATA: random lowercase letters, with ORIGINAL_STRING in
+	   a tenth of the S_DATA and I_DATA values. Half of the C_DATA values
+	   carry the history Payment prepends for bad credit customers. The
+	   seed makes every process build the same samples"""
+	rng = random.Random(seed)
+	letters = lambda low, high: "".join(rng.choice(string.ascii_lowercase) for i in xrange(rng.randint(low, high)))
+	samples = [ ]
+	for i in xrange(count):
+		c_data = letters(constants.MIN_C_DATA, constants.MAX_C_DATA)
+		while rng.random() < 0.5 and len(c_data) < constants.MAX_C_DATA:
+			w_id, d_id = rng.randint(1, 100), rng.randint(1, constants.DISTRICTS_PER_WAREHOUSE)
+			payment = [rng.randint(1, constants.CUSTOMERS_PER_DISTRICT), d_id, w_id, d_id, w_id, rng.randint(100, 500000) / 100.0]
+			c_data = (" ".join(map(str, payment)) + "|" + c_data)[:constants.MAX_C_DATA]
+		## WHILE
+		samples.append(c_data)
+		for column in ("S_DATA", "I_DATA"):
+			data = letters(constants.MIN_I_DATA, constants.MAX_I_DATA)
+			if rng.random() < 0.1:
+				pos = rng.randint(0, len(data) - len(constants.ORIGINAL_STRING))
+				data = data[:pos] + constants.ORIGINAL_STRING + data[pos + len(constants.ORIGINAL_STRING):]
+			samples.append(data)
+		## FOR
+	## FOR
+	return samples
+
+def trainDictionary(samples, size=DICTIONARY_SIZE):
+	"""Builds a deflate preset dictionary from sample values: their
+	   substrings of DICTIONARY_GRAM characters found in more than one
+	   sample, the most frequent last, where deflate reaches them with the
+	   shortest distances"""
+	counts = dict()
+	for sample in samples:
+		for gram in set(sample[i:i+DICTIONARY_GRAM] for i in xrange(len(sample) - DICTIONARY_GRAM + 1)):
+			counts[gram] = counts.get(gram, 0) + 1
+	## FOR
+	grams = sorted((n, gram) for gram, n in counts.iteritems() if n > 1)
+	return "".join(gram for n, gram in grams)[-size:]
+
+class ColumnCompressor(object):
+	"""Compresses the values of long VARCHAR columns with raw deflate.
+	   Python 2's zlib takes no preset dictionary, so values are compressed
+	   by a copy of a compressor primed with the dictionary and decompressed
+	   by a copy of a decompressor that has read it. Each value ends with a
+	   sync flush, whose fixed trailer is not stored. Zero bytes separate
+	   the columns of table records, so they are escaped"""
+
+	TRAILER = "\x00\x00\xff\xff"
+
+	def __init__(self, dictionary, level=6):
+		self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+		primed = self.compressor.compress(dictionary) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+		self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+		self.decompressor.decompress(primed)
+
+	def compress(self, value):
+		compressor = self.compressor.copy()
+		data = compressor.compress(value) + compressor.flush(zlib.Z_SYNC_FLUSH)
+		return data[:-len(self.TRAILER)].replace("\x01", "\x01\x01").replace("\x00", "\x01\x02")
+
+	def decompress(self, value):
+		## "\x01" only starts escapes, so splitting on "\x01\x01" leaves
+		## "\x01\x02" as the only escape in each part
+		data = "\x01".join(part.replace("\x01\x02", "\x00") for part in value.split("\x01\x01"))
+		return self.decompressor.copy().decompress(data + self.TRAILER)
+
+## ==============================================
+## Partitioners
+## ==============================================
+
+## A partitioner maps warehouse IDs to server IDs. Servers with a weight
+## of 0 get no warehouses, so a new server can be added to the servers
+## configuration first and filled later with tokyocabinetmigrate.py
+
+class ModuloPartitioner(object):
+	"""Assigns warehouse w to the (w mod n)-th of the n servers with a
+	   non-zero weight, in server ID order"""
+
+	def __init__(self, weights, ranges):
+		self.servers = sorted(sID for sID, weight in weights.iteritems() if weight > 0)
+
+	def getServer(self, w_id):
+		return self.servers[w_id % len(self.servers)]
+
+class HashPartitioner(object):
+	"""Consistent hashing. Every server owns points of a hash ring in
+	   proportion to its weight, and a warehouse belongs to the server
+	   owning the first point after its hash. Adding a server only moves
+	   the warehouses that hash next to its points"""
+
+	POINTS = 100
+
+	def __init__(self, weights, ranges):
+		self.ring = sorted((self.hash("%s:%d" % (sID, i)), sID)
+				for sID, weight in weights.iteritems() for i in xrange(int(weight * self.POINTS)))
+		self.hashes = [h for h, sID in self.ring]
+
+	def hash(self, value):
+		return int(hashlib.md5(str(value)).hexdigest()[:8], 16)
+
+	def getServer(self, w_id):
+		return self.ring[bisect.bisect(self.hashes, self.hash(w_id)) % len(self.ring)][1]
+
+class RangePartitioner(object):
+	"""Assigns explicit warehouse ranges to servers, given as
+	   { sID: [ (first, last), ... ] } with both ends included"""
+
+	def __init__(self, weights, ranges):
+		self.ranges = sorted((first, last, sID) for sID, rs in ranges.iteritems() for first, last in rs)
+		self.firsts = [first for first, last, sID in self.ranges]
+
+	def getServer(self, w_id):
+		i = bisect.bisect(self.firsts, w_id) - 1
+		assert i >= 0 and w_id <= self.ranges[i][1], "Warehouse %d is not in any partition range" % w_id
+		return self.ranges[i][2]
+
+PARTITIONERS = {
+	"modulo": ModuloPartitioner,
+	"hash": HashPartitioner,
+	"range": RangePartitioner,
+}
+
+def makePartitioner(config, serverIds):
+	"""Builds the partitioner selected by a driver configuration for the
+	   given servers"""
+	assert config["partitioner"] in PARTITIONERS, "Invalid partitioner '%s'" % config["partitioner"]
+	weights = dict((sID, 1) for sID in serverIds)
+	weights.update(eval(str(config["server_weights"])))
+	ranges = eval(str(config["partition_ranges"]))
+	return PARTITIONERS[config["partitioner"]](weights, ranges)
+
+## ==============================================
+## Connection pool
+## ==============================================
+
+## Marks the driver's reader threads (see runConcurrently). They take their
+## connections from separate reader pools, so a transaction thread waiting
+## for its readers never holds the connections they need
+READER_THREAD = local()
+
+def markReaderThread():
+	READER_THREAD.active = True
+
+class ConnectionPool(object):
+	"""Pool of Tyrant connections to one server's table. A thread keeps the
+	   connection it checked out until release() gives it back, so threads
+	   never share a socket. Connections idle for longer than checkInterval
+	   seconds are pinged before reuse and replaced if they are broken. A
+	   pool inherited through fork() drops the parent's sockets and starts
+	   over. Other attributes are looked up on the calling thread's
+	   connection, so a pool can be used like a pyrant.Tyrant. Reader
+	   threads use a pool of their own, of up to readers connections"""
+
+	def __init__(self, host, port, size, checkInterval, readers=0):
+		self.host = host
+		self.port = port
+		self.size = size
+		self.checkInterval = checkInterval
+		self.readers = ConnectionPool(host, port, readers, checkInterval) if readers > 0 else None
+		self.reset()
+
+	def reset(self):
+		self.pid = os.getpid()
+		self.cond = Condition()
+		self.idle = list()
+		self.opened = 0
+		self.local = local()
+
+	def __getattr__(self, name):
+		return getattr(self.connection(), name)
+
+	def connection(self):
+		"""Returns the connection checked out by the calling thread, checking
+		   one out first if it has none"""
+		if self.readers != None and getattr(READER_THREAD, "active", False):
+			return self.readers.connection()
+		if self.pid != os.getpid():
+			self.reset()
+		conn = getattr(self.local, "conn", None)
+		if conn == None:
+			conn = self.checkout()
+			self.local.conn = conn
+		return conn
+
+	def checkout(self):
+		"""Takes an idle connection, or opens a new one if the pool is not
+		   full yet. Blocks while all connections are in use"""
+		conn = None
+		with self.cond:
+			while len(self.idle) == 0 and self.opened >= self.size:
+				self.cond.wait()
+			if len(self.idle) > 0:
+				conn, lastUse = self.idle.pop()
+			else:
+				self.opened += 1
+		## WITH
+		if conn != None and time.time() - lastUse > self.checkInterval and not self.isAlive(conn):
+			logging.warn("Reconnecting to %s:%s" % (self.host, self.port))
+			conn = None
+		if conn == None:
+			try:
+				conn = pyrant.Tyrant(self.host, self.port, separator=protocol.TABLE_COLUMN_SEP)
+			except:
+				with self.cond:
+					self.opened -= 1
+					self.cond.notify()
+				raise
+		return conn
+
+	def isAlive(self, conn):
+		try:
+			conn.proto.rnum()
+			return True
+		except (socket.error, pyrant.exceptions.TyrantError):
+			return False
+
+	def release(self, broken=False):
+		"""Gives the calling thread's connection back to the pool. Broken
+		   connections are dropped instead, and will be replaced by new ones"""
+		if self.readers != None and getattr(READER_THREAD, "active", False):
+			return self.readers.release(broken)
+		if self.pid != os.getpid():
+			self.reset()
+			return
+		conn = getattr(self.local, "conn", None)
+		if conn == None:
+			return
+		self.local.conn = None
+		self.checkin(conn, broken)
+
+	def checkin(self, conn, broken=False):
+		with self.cond:
+			if broken:
+				self.opened -= 1
+			else:
+				self.idle.append((conn, time.time()))
+			self.cond.notify()
+		## WITH
+
+	def outstanding(self):
+		"""Number of connections currently checked out"""
+		if self.readers != None:
+			return self.opened - len(self.idle) + self.readers.outstanding()
+		return self.opened - len(self.idle)
+
+class ReplicaPool(ConnectionPool):
+	"""Pool of connections to a replication slave of a table's server. The
+	   slave's replication delay is read from its stats at most every
+	   delayInterval seconds. A slave that cannot be reached counts as
+	   infinitely late"""
+
+	def __init__(self, host, port, size, checkInterval, delayInterval, readers=0):
+		self.delayInterval = delayInterval
+		ConnectionPool.__init__(self, host, port, size, checkInterval, readers)
+
+	def reset(self):
+		ConnectionPool.reset(self)
+		self.delay = 0.0
+		self.delayTime = 0
+
+	def replicationDelay(self):
+		if time.time() - self.delayTime > self.delayInterval:
+			self.delayTime = time.time()
+			conn = None
+			try:
+				conn = self.checkout()
+				self.delay = float(conn.get_stats().get("delay", 0))
+				self.checkin(conn)
+			except (socket.error, pyrant.exceptions.TyrantError):
+				logging.warn("Replica %s:%s is not available" % (self.host, self.port))
+				if conn != None:
+					self.checkin(conn, True)
+				self.delay = float("inf")
+		## IF
+		return self.delay
+
+def pooled(txn):
+	"""Decorates transactions so that the connections they check out are
+	   given back to their pools when they finish. A socket error leaves
+	   the connections in an unknown state, so they are dropped. Each call
+	   also gets its own row cache (see TokyocabinetDriver.getRows), which
+	   is discarded at the end"""
+	def wrapper(self, *args):
+		broken = False
+		self.rowCache.rows = dict()
+		try:
+			return txn(self, *args)
+		except socket.error:
+			broken = True
+			raise
+		finally:
+			self.rowCache.rows = None
+			self.releaseConnections(broken)
+	wrapper.__name__ = txn.__name__
+	wrapper.__doc__ = txn.__doc__
+	return wrapper
+
+def readOnly(txn):
+	"""Decorates transactions that do not write, so that their reads may be
+	   served by replicas (see TokyocabinetDriver.readConnection)"""
+	def wrapper(self, *args):
+		self.routing.readOnly = True
+		try:
+			return txn(self, *args)
+		finally:
+			self.routing.readOnly = False
+	wrapper.__name__ = txn.__name__
+	wrapper.__doc__ = txn.__doc__
+	return wrapper
+
+def abortable(txn):
+	"""Decorates NewOrder so that, when it fails, the order ids it took but
+	   did not queue are marked as aborted, for Delivery to skip (see
+	   TokyocabinetDriver.popNewOrders). The transaction lists them in
+	   self.pendingOrders.orders, and empties it once the order is queued"""
+	def wrapper(self, *args):
+		self.pendingOrders.orders = list()
+		try:
+			return txn(self, *args)
+		except Exception as ex:
+			for w_id, d_id, o_id in self.pendingOrders.orders:
+				self.abandonOrder(w_id, d_id, o_id, isinstance(ex, socket.error))
+			raise
+		finally:
+			self.pendingOrders.orders = None
+	wrapper.__name__ = txn.__name__
+	wrapper.__doc__ = txn.__doc__
+	return wrapper
+
+## ==============================================
+## Embedded engine
+## ==============================================
+
+## With engine = embedded the driver opens the table databases in-process
+## through the Tokyo Cabinet bindings instead of connecting to ttserver.
+## EmbeddedTable emulates the subset of pyrant.Tyrant the driver uses, so
+## partitioning, keys and transactions are the same in both engines.
+
+## Tokyo Cabinet query operators for each pyrant lookup: (string, numeric)
+EMBEDDED_LOOKUPS = {
+	"eq": ("TDBQCSTREQ", "TDBQCNUMEQ"),
+	"contains": ("TDBQCSTRINC", None),
+	"gt": (None, "TDBQCNUMGT"),
+	"gte": (None, "TDBQCNUMGE"),
+	"lt": (None, "TDBQCNUMLT"),
+	"lte": (None, "TDBQCNUMLE"),
+	"between": (None, "TDBQCNUMBT"),
+	"in": ("TDBQCSTROREQ", "TDBQCNUMOREQ"),
+}
+## Tokyo Cabinet index type for each pyrant index kind
+EMBEDDED_INDEX_TYPES = {
+	"lexical": "TDBITLEXICAL",
+	"decimal": "TDBITDECIMAL",
+}
+## Functions of tokyocabinetdriver.lua that EmbeddedTable implements
+EMBEDDED_FUNCTIONS = [
+	"putcols",
+	"addcols",
+	"popqueues",
+	"sumcols",
+	"countcols",
+	"distinctcols",
+]
+## Comparisons of countcols
+COUNT_OPERATORS = {
+	"lt": lambda a, b: a < b,
+	"le": lambda a, b: a <= b,
+	"eq": lambda a, b: a == b,
+	"ge": lambda a, b: a >= b,
+	"gt": lambda a, b: a > b,
+}
+
+class EmbeddedQuery(object):
+	"""Lazy table query with the filter/order_by/columns interface of
+	   pyrant's Query. The search runs when the results are first used"""
+
+	def __init__(self, table, conds=(), order=None, names=None):
+		self.table = table
+		self.conds = list(conds)
+		self.order = order
+		self.names = names
+		self.cache = None
+
+	def copy(self, **kwargs):
+		args = dict(conds=self.conds, order=self.order, names=self.names)
+		args.update(kwargs)
+		return EmbeddedQuery(self.table, **args)
+
+	def filter(self, **lookups):
+		conds = list(self.conds)
+		for name, value in lookups.iteritems():
+			column, _, lookup = name.partition("__")
+			lookup = lookup or "eq"
+			values = value if isinstance(value, (list, tuple)) else [value]
+			numeric = all(isinstance(v, (int, long, float)) for v in values)
+			op = EMBEDDED_LOOKUPS[lookup][numeric]
+			assert op != None, "Unsupported lookup '%s' for %s" % (lookup, value)
+			conds.append((column, getattr(tctable, op), " ".join(str(v) for v in values)))
+		## FOR
+		return self.copy(conds=conds)
+
+	def order_by(self, name, numeric=False):
+		desc = name.startswith("-")
+		if numeric:
+			order = "TDBQONUMDESC" if desc else "TDBQONUMASC"
+		else:
+			order = "TDBQOSTRDESC" if desc else "TDBQOSTRASC"
+		return self.copy(order=(name.lstrip("-"), getattr(tctable, order)))
+
+	def columns(self, *names):
+		return self.copy(names=names)
+
+	def keys(self):
+		query = self.table.db.query()
+		for column, op, expr in self.conds:
+			query.addcond(column, op, expr)
+		if self.order != None:
+			query.setorder(*self.order)
+		return query.search()
+
+	def results(self):
+		if self.cache == None:
+			self.cache = list()
+			for key in self.keys():
+				cols = self.table.db.get(key)
+				if self.names:
+					cols = dict((n, cols[n]) for n in self.names if n in cols)
+				self.cache.append(cols)
+			## FOR
+		return self.cache
+
+	def __iter__(self):
+		return iter(self.results())
+
+	def __len__(self):
+		return len(self.results())
+
+	def __getitem__(self, i):
+		return self.results()[i]
+
+	def count(self):
+		return len(self.keys())
+
+class EmbeddedProtocol(object):
+	"""Low-level calls the driver makes through Tyrant.proto"""
+
+	def __init__(self, table):
+		self.table = table
+
+	def mget(self, keys):
+		result = list()
+		for key in keys:
+			try:
+				cols = self.table.db.get(key)
+			except KeyError:
+				continue
+			result.append((key, self.table.serialize(cols)))
+		## FOR
+		return result
+
+	def addint(self, key, num):
+		return self.table.db.addint(key, num)
+
+	def adddouble(self, key, num):
+		return self.table.db.adddouble(key, num)
+
+	def fwmkeys(self, prefix):
+		return self.table.db.fwmkeys(prefix)
+
+	def add_index(self, name, kind):
+		self.table.db.setindex(name, getattr(tctable, EMBEDDED_INDEX_TYPES[kind]))
+
+	def optimize_index(self, name):
+		self.table.db.setindex(name, tctable.TDBITOPT)
+
+	def sync(self):
+		self.table.db.sync()
+
+class EmbeddedTable(object):
+	"""One table database file opened in-process"""
+
+	def __init__(self, path):
+		self.path = path
+		self.db = tctable.Table()
+		self.db.open(path, tctable.TDBOWRITER | tctable.TDBOCREAT)
+		self.proto = EmbeddedProtocol(self)
+		## Guards read-modify-write updates, like the record and global
+		## locks of Tyrant extension calls
+		self.lock = Lock()
+
+	def serialize(self, cols):
+		return protocol.TABLE_COLUMN_SEP.join("%s%s%s" % (name, protocol.TABLE_COLUMN_SEP, v) for name, v in cols.iteritems())
+
+	@property
+	def query(self):
+		return EmbeddedQuery(self)
+
+	def multi_set(self, items):
+		for key, cols in items:
+			self.db.put(key, dict((name, str(v)) for name, v in cols.iteritems()))
+		## FOR
+
+	def multi_del(self, keys):
+		for key in keys:
+			try:
+				self.db.out(key)
+			except KeyError:
+				pass
+		## FOR
+
+	def call_func(self, func, key, value, record_locking=False, global_locking=False):
+		## Only the helper functions have an embedded implementation;
+		## transaction procedures need ttserver
+		assert func in EMBEDDED_FUNCTIONS, "Function '%s' is not available in embedded mode" % func
+		with self.lock:
+			return getattr(self, func)(key.split(protocol.TABLE_COLUMN_SEP), value)
+
+	def putcols(self, keys, value):
+		elems = value.split(protocol.TABLE_COLUMN_SEP)
+		cols = dict(zip(elems[::2], elems[1::2]))
+		updated = 0
+		for k in keys:
+			try:
+				record = self.db.get(k)
+			except KeyError:
+				continue
+			record.update(cols)
+			self.db.put(k, record)
+			updated += 1
+		## FOR
+		return str(updated) if updated > 0 else None
+
+	def addcols(self, keys, value):
+		args = value.split(protocol.TABLE_COLUMN_SEP)
+		n = int(args[0])
+		columns = args[1:n+1]
+		for i, k in enumerate(keys):
+			try:
+				record = self.db.get(k)
+			except KeyError:
+				return None
+			increments = args[n+1+i*n:n+1+(i+1)*n]
+			for c, v in zip(columns, increments):
+				record[c] = str(TYPE_DECODERS[COLUMN_TYPES[c]](record[c]) + TYPE_DECODERS[COLUMN_TYPES[c]](v))
+			self.db.put(k, record)
+		## FOR
+		return str(len(keys))
+
+	def popqueues(self, keys, value):
+		result = list()
+		for k in keys:
+			rest = k.split(":", 1)[1]
+			head = self.db.addint(k, 0)
+			o_id = head
+			result.append("")
+			while True:
+				try:
+					self.db.out("%d:%s" % (o_id, rest))
+				except KeyError:
+					try:
+						self.db.out("ABORTED:%d:%s" % (o_id, rest))
+					except KeyError:
+						break
+					o_id += 1
+					continue
+				try:
+					self.db.out("ABORTED:%d:%s" % (o_id, rest))
+				except KeyError:
+					pass
+				result[-1] = str(o_id)
+				o_id += 1
+				break
+			## WHILE
+			if o_id > head:
+				self.db.addint(k, o_id-head)
+		## FOR
+		return protocol.TABLE_COLUMN_SEP.join(result)
+
+	def values(self, keys, column):
+		for k in keys:
+			try:
+				yield self.db.get(k)[column]
+			except KeyError:
+				continue
+		## FOR
+
+	def sumcols(self, keys, value):
+		args = value.split(protocol.TABLE_COLUMN_SEP)
+		result = list()
+		first = 0
+		for size in args[1:]:
+			result.append(str(sum(float(v) for v in self.values(keys[first:first+int(size)], args[0]))))
+			first += int(size)
+		## FOR
+		return protocol.TABLE_COLUMN_SEP.join(result)
+
+	def countcols(self, keys, value):
+		args = value.split(protocol.TABLE_COLUMN_SEP)
+		values = self.values(keys, args[0])
+		if len(args) > 1:
+			values = [v for v in values if COUNT_OPERATORS[args[1]](float(v), float(args[2]))]
+		return str(len(list(values)))
+
+	def distinctcols(self, keys, value):
+		return protocol.TABLE_COLUMN_SEP.join(set(self.values(keys, value)))
+
+	def clear(self):
+		self.db.vanish()
+
+	def release(self, broken=False):
+		## The handle is shared by all threads, there is nothing to give back
+		pass
+
 ## ==============================================
 ## TokyocabinetDriver
 ## ==============================================
@@ -207,13 +1186,74 @@ class TokyocabinetDriver(AbstractDriver):
 		constants.TABLENAME_ORDERS + '" : { "host": "localhost", "port": 1983, },"' +
 		constants.TABLENAME_NEW_ORDER + '" : { "host": "localhost", "port": 1984, },"' +
 		constants.TABLENAME_ORDER_LINE+ '" : { "host": "localhost", "port": 1985, },"' +
-		constants.TABLENAME_HISTORY + '" : { "host": "localhost",	"port": 1986, }, }, }' ), }
+		constants.TABLENAME_HISTORY + '" : { "host": "localhost",	"port": 1986, }, }, }' ),
+		"batch_size": ("Number of records sent in each multi_set call while loading", 1000),
+		"item_cache": ("ITEM cache mode: 'bulk' caches the whole table at startup, 'lazy' caches items on first use, 'off' always reads them from the server", "bulk"),
+		"item_cache_size": ("Maximum number of items kept by a 'lazy' ITEM cache", constants.NUM_ITEMS),
+		"procedures": ("Run transactions as Lua procedures inside ttserver, one call per table they touch", False),
+		"engine": ("'tyrant' connects to the ttserver of each table, 'embedded' opens the table databases in-process (the servers only define the partitions)", "tyrant"),
+		"data_dir": ("Directory of the table database files of the embedded engine", "/tmp/tpcc-tokyocabinet"),
+		"pool_size": ("Maximum number of connections of the transaction threads to each server's table", 8),
+		"pool_check_interval": ("Seconds a pooled connection may stay idle before it is checked before reuse", 30),
+		"partitioner": ("How warehouses are assigned to servers: 'modulo', 'hash' (consistent hashing) or 'range'", "modulo"),
+		"server_weights": ("Relative weights of the servers, as a stringified dictionary { sID: weight }. Servers default to 1, 0 assigns no warehouses", "{ }"),
+		"partition_ranges": ("Warehouse ranges of the 'range' partitioner, as a stringified dictionary { sID: [ (first, last), ... ] }", "{ }"),
+		"partition_refresh": ("Seconds between reloads of the warehouses moved by tokyocabinetmigrate.py", 10),
+		"concurrent_reads": ("Overlap the independent reads of NewOrder and Payment on a pool of reader threads", False),
+		"read_threads": ("Number of reader threads shared by the transactions, and of their own connections to each server's table", 8),
+		"replica_max_lag": ("Seconds of replication delay above which OrderStatus and StockLevel read from the master instead of a replica", 5),
+		"replica_check_interval": ("Seconds between reads of the replication delay of each replica", 5),
+		"compress_columns": ("Comma-separated VARCHAR columns stored deflate-compressed, e.g. C_DATA. Not available with procedures", ""),
+		"split_tables": ("Store CUSTOMER and STOCK rows as a hot record with the columns transactions update and a cold one with the descriptive columns", False),
+		"affinity": ("Assign each client process to one server: its transactions move to that server's warehouses and it keeps a single connection to each other server's tables", False),
+		"affinity_workers": ("Client processes per server in each round of the affinity assignment, as a stringified dictionary { sID: count }. Servers default to 1, or 0 if their weight is 0", "{ }"),
+		"ordered_tables": ("Keep ORDERS, NEW_ORDER and ORDER_LINE in B+tree databases (.tcb) under ordered keys, so Delivery and StockLevel scan key ranges", False),
+	}
 
 	def __init__(self, ddl):
 		super(TokyocabinetDriver, self).__init__("tokyocabinet", ddl)
 		self.databases = dict()
 		self.conn = dict()
 		self.numServers = 0
+		self.partitioner = None
+		self.partitionMap = dict()
+		self.partitionMapTime = 0
+		self.partitionRefresh = 10
+		self.partitionMapLock = Lock()
+		self.batchSize = 1000
+		self.itemCacheMode = "off"
+		self.itemCacheSize = 0
+		self.itemCache = None
+		self.useProcedures = False
+		self.engine = "tyrant"
+		self.poolSize = 8
+		self.poolCheckInterval = 30
+		self.nameIndex = dict()
+		self.lastOrders = dict()
+		self.queueHeads = dict()
+		self.concurrentReads = False
+		self.readThreads = 8
+		self.readPool = None
+		self.readPoolPid = None
+		self.readPoolLock = Lock()
+		self.loadPool = None
+		self.loadPoolPid = None
+		self.replicas = dict()
+		self.replicaMaxLag = 5
+		self.replicaCheckInterval = 5
+		self.routing = local()
+		self.keyCodecs = dict()
+		self.recordCodecs = dict((tableName, RecordCodec(tableName)) for tableName in TABLE_COLUMNS.keys())
+		self.rowCache = local()
+		self.pendingOrders = local()
+		self.splitTables = dict()
+		self.compressedColumns = frozenset()
+		self.compressor = None
+		self.affinity = False
+		self.affinityWorkers = dict()
+		self.homeServer = None
+		self.homeWarehouses = None
+		self.affinityStats = None
 
 	##-----------------------------------------------
 	## self.tupleToString
@@ -229,8 +1269,525 @@ class TokyocabinetDriver(AbstractDriver):
 	##-----------------------------------------------
 	def getServer(self, warehouseID):
 		"""Tokyo Cabinet does not support data partitioning. For the TPC-C
-		benchmark, we manually partition data based on the warehouse ID"""
-		return (warehouseID % self.numServers)
+		benchmark, we manually partition data based on the warehouse ID,
+		with the configured partitioner. Warehouses moved since the load
+		are found in the partition map instead. While a warehouse is being
+		moved, its transactions wait for the move to finish"""
+		self.refreshPartitionMap()
+		sID = self.partitionMap.get(warehouseID)
+		while sID == PARTITION_MOVING:
+			time.sleep(1)
+			self.refreshPartitionMap(force=True)
+			sID = self.partitionMap.get(warehouseID)
+		## WHILE
+		if sID != None:
+			return sID
+		return self.partitioner.getServer(warehouseID)
+
+	##-----------------------------------------------
+	## self.refreshPartitionMap
+	##-----------------------------------------------
+	def refreshPartitionMap(self, force=False):
+		"""Reloads the partition map, at most every partition_refresh
+		   seconds. The map is kept in "PARTITION:<w_id>" records, whose
+		   SERVER column is the warehouse's server. They are written to the
+		   (replicated) ITEM table of every server by migrateWarehouse"""
+		if not force and time.time() - self.partitionMapTime < self.partitionRefresh:
+			return
+		with self.partitionMapLock:
+			if not force and time.time() - self.partitionMapTime < self.partitionRefresh:
+				return
+			proto = self.conn[min(self.conn.keys())][constants.TABLENAME_ITEM].proto
+			partitionMap = dict()
+			for key, value in proto.mget(proto.fwmkeys("PARTITION:")):
+				partitionMap[int(key.split(":")[1])] = int(self.stringToRecord(value)["SERVER"])
+			## FOR
+			self.partitionMap = partitionMap
+			self.partitionMapTime = time.time()
+		## WITH
+
+	##-----------------------------------------------
+	## self.stringToRecord
+	##-----------------------------------------------
+	def stringToRecord(self, value):
+		"""Transforms a serialized table record (column names and values
+		   separated by the TC column separator) into a dictionary"""
+		elems = value.split(protocol.TABLE_COLUMN_SEP)
+		return dict(zip(elems[::2], elems[1::2]))
+
+	##-----------------------------------------------
+	## self.getRecords
+	##-----------------------------------------------
+	def getRecords(self, sID, tableName, keys):
+		"""Fetches records directly by primary key, without going through the
+		   table query engine. Keys are tuples of the TABLE_KEYS columns and
+		   all of them are fetched in a single round trip. Returns one column
+		   dictionary per key, in the same order. Missing records are None"""
+		strKeys = [self.recordKey(tableName, k) for k in keys]
+		found = dict(self.readConnection(sID, tableName).proto.mget(strKeys))
+		return [self.stringToRecord(found[k]) if k in found else None for k in strKeys]
+
+	##-----------------------------------------------
+	## self.getRecord
+	##-----------------------------------------------
+	def getRecord(self, sID, tableName, key):
+		"""Fetches a single record by primary key. Returns None if the record
+		   does not exist"""
+		return self.getRecords(sID, tableName, [key])[0]
+
+	##-----------------------------------------------
+	## self.getRows
+	##-----------------------------------------------
+	def getRows(self, sID, tableName, keys, part=None):
+		"""Same as getRecords, but returns the rows as typed records (see
+		   RecordCodec), so transactions need no conversions. part selects
+		   the "hot" or "cold" half of split rows (see HOT_COLUMNS); by
+		   default both halves are read. Inside a transaction rows go
+		   through its row cache: a row is fetched at most once, and every
+		   read returns the same record, including the changes written by
+		   putRows and updateRecords"""
+		if not tableName in self.splitTables: part = None
+		strKeys = [self.recordKey(tableName, k) for k in keys]
+		cache = getattr(self.rowCache, "rows", None)
+		if cache == None:
+			return self.fetchRows(sID, tableName, strKeys, part)
+
+		missing = [k for k in strKeys if not (sID, tableName, k, part) in cache]
+		if len(missing) > 0:
+			for k, row in zip(missing, self.fetchRows(sID, tableName, missing, part)):
+				cache[(sID, tableName, k, part)] = row
+		## IF
+		return [cache[(sID, tableName, k, part)] for k in strKeys]
+
+	##-----------------------------------------------
+	## self.fetchRows
+	##-----------------------------------------------
+	def fetchRows(self, sID, tableName, strKeys, part):
+		"""Reads and decodes rows by key string, in one round trip. The
+		   halves of a split row are merged into one record"""
+		codec = self.recordCodecs[tableName]
+		split = tableName in self.splitTables
+		hot = part != "cold" or not split
+		cold = part != "hot" and split
+		parts = [ ]
+		for k in strKeys:
+			parts.append(([k] if hot else [ ]) + ([self.coldKey(k)] if cold else [ ]))
+		## FOR
+		found = dict(self.readConnection(sID, tableName).proto.mget([f for fs in parts for f in fs]))
+		rows = [ ]
+		for fs in parts:
+			values = [found.get(f) for f in fs]
+			rows.append(codec.decode(protocol.TABLE_COLUMN_SEP.join(values)) if not None in values else None)
+		## FOR
+		return rows
+
+	##-----------------------------------------------
+	## self.getRow
+	##-----------------------------------------------
+	def getRow(self, sID, tableName, key, part=None):
+		return self.getRows(sID, tableName, [key], part)[0]
+
+	##-----------------------------------------------
+	## self.putRows
+	##-----------------------------------------------
+	def putRows(self, sID, tableName, rows, part=None):
+		"""Stores whole typed records, given as (primary key, record) pairs,
+		   in a single round trip. part limits the write to one half of
+		   split rows"""
+		if not tableName in self.splitTables: part = None
+		codec = self.recordCodecs[tableName]
+		rows = [(self.recordKey(tableName, k), r) for k, r in rows]
+		records = [ ]
+		for k, r in rows:
+			if not tableName in self.splitTables:
+				records.append((k, codec.encode(r)))
+				continue
+			hot, cold = self.splitTables[tableName]
+			if part != "cold":
+				records.append((k, codec.encode(r, hot)))
+			if part != "hot":
+				records.append((self.coldKey(k), codec.encode(r, cold)))
+		## FOR
+		self.conn[sID][tableName].multi_set(records)
+		cache = getattr(self.rowCache, "rows", None)
+		if cache != None:
+			for k, r in rows:
+				cache[(sID, tableName, k, part)] = r
+		## IF
+
+	##-----------------------------------------------
+	## self.updateRecords
+	##-----------------------------------------------
+	def updateRecords(self, sID, tableName, keys, cols):
+		"""Writes the given columns into existing records, leaving their
+		   other columns untouched. The columns of split rows go to the
+		   half they belong to"""
+		strKeys = [self.recordKey(tableName, k) for k in keys]
+		if tableName in self.splitTables:
+			hot, cold = self.splitTables[tableName]
+			hotCols = dict((name, v) for name, v in cols.iteritems() if name in hot)
+			coldCols = dict((name, v) for name, v in cols.iteritems() if not name in hot)
+			if len(hotCols) > 0:
+				self.putColumns(sID, tableName, strKeys, hotCols)
+			if len(coldCols) > 0:
+				self.putColumns(sID, tableName, [self.coldKey(k) for k in strKeys], coldCols)
+		else:
+			self.putColumns(sID, tableName, strKeys, cols)
+		## IF
+
+		## Cached rows see the update
+		cache = getattr(self.rowCache, "rows", None)
+		if cache != None:
+			for k in strKeys:
+				for part in (None, "hot", "cold"):
+					row = cache.get((sID, tableName, k, part))
+					if row != None: row.update(cols)
+				## FOR
+			## FOR
+		## IF
+
+	##-----------------------------------------------
+	## self.putColumns
+	##-----------------------------------------------
+	def putColumns(self, sID, tableName, strKeys, cols):
+		"""Merges columns into the records with the given key strings. Only
+		   the changed columns are sent: the merge runs on the server, in
+		   the putcols function of tokyocabinetdriver.lua"""
+		codec = self.recordCodecs[tableName]
+		value = protocol.TABLE_COLUMN_SEP.join("%s%s%s" % (name, protocol.TABLE_COLUMN_SEP, codec.encodeValue(name, v))
+				for name, v in cols.iteritems())
+		## Single records are locked by key; updates spanning several
+		## records need the global lock
+		self.conn[sID][tableName].call_func("putcols", protocol.TABLE_COLUMN_SEP.join(strKeys), value,
+				record_locking=(len(strKeys) == 1), global_locking=(len(strKeys) > 1))
+
+	##-----------------------------------------------
+	## self.addColumns
+	##-----------------------------------------------
+	def addColumns(self, sID, tableName, keys, columns, increments):
+		"""Adds to numeric columns of existing records, on the server, in the
+		   addcols function of tokyocabinetdriver.lua. increments holds a
+		   tuple per key, with one value per column. The columns of split
+		   rows must be hot"""
+		if tableName in self.splitTables:
+			assert all(c in self.splitTables[tableName][0] for c in columns), "Only hot columns can be added to"
+		strKeys = [self.recordKey(tableName, k) for k in keys]
+		value = protocol.TABLE_COLUMN_SEP.join([str(len(columns))] + columns +
+				[str(v) for values in increments for v in values])
+		result = self.conn[sID][tableName].call_func("addcols", protocol.TABLE_COLUMN_SEP.join(strKeys), value,
+				record_locking=(len(strKeys) == 1), global_locking=(len(strKeys) > 1))
+		assert result, "Missing %s records" % tableName
+
+		## Cached rows see the update
+		cache = getattr(self.rowCache, "rows", None)
+		if cache != None:
+			for k, values in zip(strKeys, increments):
+				for part in (None, "hot"):
+					row = cache.get((sID, tableName, k, part))
+					if row == None: continue
+					for c, v in zip(columns, values):
+						row[c] += v
+				## FOR
+			## FOR
+		## IF
+
+	##-----------------------------------------------
+	## self.updateRecord
+	##-----------------------------------------------
+	def updateRecord(self, sID, tableName, key, cols):
+		"""Writes the given columns into an existing record"""
+		self.updateRecords(sID, tableName, [key], cols)
+
+	##-----------------------------------------------
+	## self.stringToList
+	##-----------------------------------------------
+	def stringToList(self, value):
+		"""Splits a list returned by a Lua procedure"""
+		if value == "": return [ ]
+		return value.split(protocol.TABLE_COLUMN_SEP)
+
+	##-----------------------------------------------
+	## self.callProcedure
+	##-----------------------------------------------
+	def callProcedure(self, sID, tableName, func, keys, args, locking=False):
+		"""Calls a transaction procedure of tokyocabinetdriver.lua on one
+		   server's table. keys are key strings and args the procedure
+		   parameters. Procedures that read and then write records must run
+		   with locking, which holds the table's global lock during the call.
+		   Returns the raw string result"""
+		sep = protocol.TABLE_COLUMN_SEP
+		conn = self.conn[sID][tableName] if locking else self.readConnection(sID, tableName)
+		return conn.call_func(func, sep.join(keys),
+				sep.join(str(a) for a in args), global_locking=locking)
+
+	##-----------------------------------------------
+	## self.aggregate
+	##-----------------------------------------------
+	def aggregate(self, sID, tableName, func, keys, column, args=[ ]):
+		"""Aggregates a column over the records with the given primary keys
+		   on the server, with the sumcols, countcols or distinctcols
+		   function of tokyocabinetdriver.lua, so only the results travel
+		   back. Missing records are skipped. Returns the results as a list
+		   of strings"""
+		if len(keys) == 0: return [ ]
+		sep = protocol.TABLE_COLUMN_SEP
+		result = self.readConnection(sID, tableName).call_func(func, sep.join(self.recordKey(tableName, k) for k in keys),
+				sep.join([column] + [str(a) for a in args]))
+		return self.stringToList(result)
+
+	##-----------------------------------------------
+	## self.aggregateRange
+	##-----------------------------------------------
+	def aggregateRange(self, sID, tableName, func, begin, end, column, args=[ ]):
+		"""Same as aggregate, over the records of an ordered table whose keys
+		   are between begin (included) and end (excluded), found by a
+		   range scan of the B+tree instead of a list of keys"""
+		sep = protocol.TABLE_COLUMN_SEP
+		result = self.readConnection(sID, tableName).call_func("rangecols", sep.join([begin, end, func]),
+				sep.join([column] + [str(a) for a in args]))
+		return self.stringToList(result)
+
+	##-----------------------------------------------
+	## self.counterKey
+	##-----------------------------------------------
+	def counterKey(self, column, key):
+		"""Returns the key of the counter record holding a TABLE_COUNTERS
+		   column for the row with the given primary key tuple"""
+		return self.tupleToString((column,) + tuple(key))
+
+	##-----------------------------------------------
+	## self.recordKey
+	##-----------------------------------------------
+	def recordKey(self, tableName, key):
+		"""Returns the key string of the row of a table with the given
+		   primary key tuple: its KeyCodec encoding for ordered tables, its
+		   tupleToString otherwise"""
+		codec = self.keyCodecs.get(tableName)
+		if codec != None:
+			return codec.encode(key)
+		return self.tupleToString(key)
+
+	##-----------------------------------------------
+	## self.coldKey
+	##-----------------------------------------------
+	def coldKey(self, strKey):
+		"""Returns the key of the cold half of a split row (see HOT_COLUMNS),
+		   given the key string of the row"""
+		return "COLD:" + strKey
+
+	##-----------------------------------------------
+	## self.addCounter
+	##-----------------------------------------------
+	def addCounter(self, sID, tableName, column, key, num):
+		"""Atomically adds num to a counter column of the given row and
+		   returns the new value. Adding 0 reads the counter"""
+		proto = self.conn[sID][tableName].proto
+		if COLUMN_TYPES[column] == "FLOAT":
+			return proto.adddouble(self.counterKey(column, key), num)
+		return proto.addint(self.counterKey(column, key), num)
+
+	##-----------------------------------------------
+	## self.readCounter
+	##-----------------------------------------------
+	def readCounter(self, sID, tableName, column, key):
+		"""Returns the value of a counter column without updating it, so
+		   that it can be read from a replica. Missing counters are 0"""
+		record = self.getRecord(sID, tableName, (column,) + tuple(key))
+		value = record["_num"] if record != None else 0
+		if COLUMN_TYPES[column] == "FLOAT":
+			return float(value)
+		return int(value)
+
+	##-----------------------------------------------
+	## self.readConnection
+	##-----------------------------------------------
+	def readConnection(self, sID, tableName):
+		"""Returns the connection pool reads of the calling thread go to.
+		   Inside read-only transactions this is the replica of the table
+		   with the fewest outstanding requests, among the ones lagging at
+		   most replica_max_lag seconds behind. A thread keeps reading from
+		   the replica it already holds a connection to, so a transaction
+		   sees a single copy of each table. Without a usable replica, and
+		   outside read-only transactions, it is the master"""
+		replicas = self.replicas.get(sID, { }).get(tableName)
+		if not replicas or not getattr(self.routing, "readOnly", False):
+			return self.conn[sID][tableName]
+		for replica in replicas:
+			if getattr(replica.local, "conn", None) != None:
+				return replica
+		## FOR
+		replicas = [r for r in replicas if r.replicationDelay() <= self.replicaMaxLag]
+		if len(replicas) == 0:
+			return self.conn[sID][tableName]
+		return min(replicas, key=lambda r: r.outstanding())
+
+	##-----------------------------------------------
+	## self.nameIndexKey
+	##-----------------------------------------------
+	def nameIndexKey(self, w_id, d_id, c_last):
+		"""Returns the key of the CUSTOMER record listing the C_IDs of the
+		   customers of a district with the given last name. The list is
+		   kept in its C_IDS column, sorted by C_FIRST"""
+		return self.tupleToString(("C_LAST", w_id, d_id, c_last))
+
+	##-----------------------------------------------
+	## self.getCustomerByLastName
+	##-----------------------------------------------
+	def getCustomerByLastName(self, sID, w_id, d_id, c_last):
+		"""Returns the midpoint customer, ordered by C_FIRST, of the ones with
+		   the given last name, or None if there are none"""
+		index = self.getRecords(sID, constants.TABLENAME_CUSTOMER, [("C_LAST", w_id, d_id, c_last)])[0]
+		if index == None:
+			return None
+		c_ids = index["C_IDS"].split()
+		c_id = int(c_ids[(len(c_ids)-1)/2])
+		return self.getRow(sID, constants.TABLENAME_CUSTOMER, (c_id, d_id, w_id))
+
+	##-----------------------------------------------
+	## self.lastOrderKey
+	##-----------------------------------------------
+	def lastOrderKey(self, w_id, d_id, c_id):
+		"""Returns the key of the ORDERS record holding, in its O_ID column,
+		   the id of the given customer's most recent order"""
+		return self.tupleToString(("O_C_ID", w_id, d_id, c_id))
+
+	##-----------------------------------------------
+	## self.popNewOrders
+	##-----------------------------------------------
+	def popNewOrders(self, sID, w_id, d_ids):
+		"""Removes the oldest new order of each district and returns their
+		   ids, or None for districts that have none. The head of a
+		   district's queue is its NO_O_ID counter in NEW_ORDER. All queues
+		   are popped in one round trip, by the popqueues function of
+		   tokyocabinetdriver.lua, which holds the global lock so an order is
+		   never delivered twice. A queue stops at an id with no new order
+		   yet, whose NewOrder is still running, unless the id was marked
+		   as aborted (see abandonOrder). With ordered_tables a district's
+		   oldest new order is simply the first key of its range, removed by
+		   popranges"""
+		codec = self.keyCodecs.get(constants.TABLENAME_NEW_ORDER)
+		if codec != None:
+			keys = [ ]
+			for d_id in d_ids:
+				keys.extend((codec.prefix(w_id, d_id), codec.prefix(w_id, d_id+1)))
+			result = self.conn[sID][constants.TABLENAME_NEW_ORDER].call_func("popranges",
+					protocol.TABLE_COLUMN_SEP.join(keys), "", global_locking=True)
+			return [codec.decode(key)[0] if key else None for key in result.split(protocol.TABLE_COLUMN_SEP)]
+		## IF
+		keys = [self.counterKey("NO_O_ID", (d_id, w_id)) for d_id in d_ids]
+		result = self.conn[sID][constants.TABLENAME_NEW_ORDER].call_func("popqueues",
+				protocol.TABLE_COLUMN_SEP.join(keys), "", global_locking=True)
+		return [int(o_id) if o_id else None for o_id in result.split(protocol.TABLE_COLUMN_SEP)]
+
+	##-----------------------------------------------
+	## self.takeOrderId
+	##-----------------------------------------------
+	def takeOrderId(self, sID, w_id, d_id, pending):
+		"""Increments the district's D_NEXT_O_ID and returns the order id it
+		   held. The id is added to pending, the list of the calling
+		   NewOrder (see abortable), which may run this on a reader thread"""
+		o_id = self.addCounter(sID, constants.TABLENAME_DISTRICT, "D_NEXT_O_ID", (d_id, w_id), 1) - 1
+		pending.append((w_id, d_id, o_id))
+		return o_id
+
+	##-----------------------------------------------
+	## self.abandonOrder
+	##-----------------------------------------------
+	def abandonOrder(self, w_id, d_id, o_id, broken=False):
+		"""Marks an order id whose NewOrder failed before queuing it with an
+		   "ABORTED:<o_id>:<d_id>:<w_id>" record in NEW_ORDER, which Delivery
+		   skips and removes. Without it the district's queue would wait
+		   for the order forever. The connection is replaced first if the
+		   failure broke it. If the marker cannot be written either, the
+		   district stays blocked and an error is logged. Ordered queues
+		   need no marker: popranges does not wait for missing orders"""
+		if constants.TABLENAME_NEW_ORDER in self.keyCodecs:
+			return
+		sID = self.getServer(w_id)
+		conn = self.conn[sID][constants.TABLENAME_NEW_ORDER]
+		conn.release(broken)
+		key = self.tupleToString(("ABORTED", o_id, d_id, w_id))
+		try:
+			conn.multi_set([(key, {"NO_O_ID": o_id, "NO_D_ID": d_id, "NO_W_ID": w_id})])
+		except (socket.error, pyrant.exceptions.TyrantError):
+			conn.release(True)
+			logging.error("Order %d of district (%d, %d) could not be marked as aborted, Delivery will wait for it" % (o_id, d_id, w_id))
+
+	##-----------------------------------------------
+	## self.releaseConnections
+	##-----------------------------------------------
+	def releaseConnections(self, broken=False):
+		"""Gives every connection the calling thread checked out back to its
+		   pool (see ConnectionPool.release)"""
+		for tables in self.conn.itervalues():
+			for conn in tables.itervalues():
+				conn.release(broken)
+		## FOR
+		for tables in self.replicas.itervalues():
+			for replicas in tables.itervalues():
+				for replica in replicas:
+					replica.release(broken)
+		## FOR
+
+	##-----------------------------------------------
+	## self.concurrently
+	##-----------------------------------------------
+	def concurrently(self, *calls):
+		"""Runs independent calls (functions without arguments) at the same
+		   time on the driver's reader threads, so a transaction waits for
+		   the slowest of its reads instead of their sum. Returns the results
+		   in order. Without concurrent_reads the calls run one after the
+		   other"""
+		if not self.concurrentReads:
+			return [call() for call in calls]
+		return self.runConcurrently(calls)
+
+	##-----------------------------------------------
+	## self.runConcurrently
+	##-----------------------------------------------
+	def runConcurrently(self, calls):
+		"""Runs a list of calls on the driver's reader threads and returns
+		   their results in order"""
+		if len(calls) <= 1:
+			return [call() for call in calls]
+		with self.readPoolLock:
+			## Threads do not survive fork()
+			if self.readPoolPid != os.getpid():
+				self.readPool = ThreadPool(self.readThreads, markReaderThread)
+				self.readPoolPid = os.getpid()
+		## WITH
+		rows = getattr(self.rowCache, "rows", None)
+		return self.readPool.map(lambda call: self.runPooled(call, rows), calls)
+
+	@pooled
+	def runPooled(self, call, rows):
+		"""Runs call with the given row cache, the one of the transaction it
+		   belongs to, then gives the connections it used back to the pools"""
+		self.rowCache.rows = rows
+		return call()
+
+	##-----------------------------------------------
+	## self.parallelMap
+	##-----------------------------------------------
+	def parallelMap(self, func, args):
+		"""Applies func to every element of args concurrently and returns the
+		   results in order. The threads are created once, one per server's
+		   table, and reused by every call. Each thread gives its
+		   connections back to the pools when it is done"""
+		def run(arg):
+			try:
+				return func(arg)
+			finally:
+				self.releaseConnections()
+		if len(args) <= 1:
+			return map(run, args)
+		with self.readPoolLock:
+			## Threads do not survive fork()
+			if self.loadPoolPid != os.getpid():
+				self.loadPool = ThreadPool(sum(len(tables) for tables in self.conn.itervalues()))
+				self.loadPoolPid = os.getpid()
+		## WITH
+		return self.loadPool.map(run, args)
 
 	## ----------------------------------------------
 	## makeDefaultConfig
@@ -252,11 +1809,34 @@ class TokyocabinetDriver(AbstractDriver):
 			for serverId, tables in config["servers"].iteritems():
 				self.databases[serverId] = tables
 
+		self.engine = config["engine"]
+		assert self.engine in ("tyrant", "embedded"), "Invalid engine '%s'" % self.engine
+		if self.engine == "embedded":
+			assert tctable != None, "The embedded engine needs the tokyocabinet Python bindings"
+		self.poolSize = int(config["pool_size"])
+		assert self.poolSize > 0, "Invalid pool_size '%s'" % config["pool_size"]
+		self.poolCheckInterval = float(config["pool_check_interval"])
+		self.readThreads = int(config["read_threads"])
+		assert self.readThreads > 0, "Invalid read_threads '%s'" % config["read_threads"]
+
 		# First connect to databases
 		for serverId, tables in self.databases.iteritems():
 			self.conn[serverId] = dict()
 			for tab, values in tables.iteritems():
-				self.conn[serverId][tab] = pyrant.Tyrant(values["host"], values["port"])
+				self.conn[serverId][tab] = self.openTable(config, serverId, tab, values)
+		## FOR
+
+		# Replication slaves serve the reads of OrderStatus and StockLevel
+		self.replicaMaxLag = float(config["replica_max_lag"])
+		self.replicaCheckInterval = float(config["replica_check_interval"])
+		for serverId, tables in self.databases.iteritems():
+			self.replicas[serverId] = dict()
+			for tab, values in tables.iteritems():
+				if len(values.get("replicas", [ ])) == 0: continue
+				assert self.engine == "tyrant", "Replicas need the tyrant engine"
+				self.replicas[serverId][tab] = [ReplicaPool(r["host"], r["port"], self.poolSize,
+						self.poolCheckInterval, self.replicaCheckInterval, self.readThreads) for r in values["replicas"]]
+			## FOR
 		## FOR
 
 		# Remove previous data
@@ -267,11 +1847,73 @@ class TokyocabinetDriver(AbstractDriver):
 					self.conn[serverId][tab].clear()
 				## FOR
 			## FOR
+			self.releaseConnections()
 		## IF
 
 		self.numServers = len(self.databases.keys())
 		logging.info("Number of servers: %s" % self.numServers)
 
+		self.partitioner = makePartitioner(config, self.databases.keys())
+		self.partitionRefresh = float(config["partition_refresh"])
+
+		self.batchSize = int(config["batch_size"])
+		assert self.batchSize > 0, "Invalid batch_size '%s'" % config["batch_size"]
+
+		self.itemCacheMode = config["item_cache"]
+		assert self.itemCacheMode in ("bulk", "lazy", "off"), "Invalid item_cache '%s'" % self.itemCacheMode
+		self.itemCacheSize = int(config["item_cache_size"])
+		if self.itemCacheMode == "lazy":
+			self.itemCache = dict()
+
+		self.useProcedures = str(config["procedures"]).lower() in ("true", "yes", "1")
+		assert not (self.useProcedures and self.engine == "embedded"), "Procedures need the tyrant engine"
+
+		self.compressedColumns = frozenset(c.strip() for c in str(config["compress_columns"]).split(",") if c.strip())
+		if len(self.compressedColumns) > 0:
+			for column in self.compressedColumns:
+				assert COLUMN_TYPES.get(column) == "VARCHAR", "Invalid compressed column '%s'" % column
+			assert not self.useProcedures, "Procedures cannot read compressed columns"
+			self.compressor = ColumnCompressor(trainDictionary(sampleColumns(DICTIONARY_SAMPLES)))
+			self.recordCodecs = dict((tableName, RecordCodec(tableName, self.compressedColumns, self.compressor))
+					for tableName in TABLE_COLUMNS.keys())
+		## IF
+
+		if str(config["split_tables"]).lower() in ("true", "yes", "1"):
+			for tableName, columns in HOT_COLUMNS.iteritems():
+				cold = [c for c in TABLE_COLUMNS[tableName] if not c in columns or c in TABLE_KEYS[tableName]]
+				self.splitTables[tableName] = (frozenset(columns), frozenset(cold))
+		## IF
+
+		if str(config["ordered_tables"]).lower() in ("true", "yes", "1"):
+			assert self.engine == "tyrant", "Ordered tables need the tyrant engine"
+			self.keyCodecs = dict((tableName, KeyCodec(tableName)) for tableName in ORDERED_KEYS.keys())
+
+		self.concurrentReads = str(config["concurrent_reads"]).lower() in ("true", "yes", "1")
+
+		self.affinity = str(config["affinity"]).lower() in ("true", "yes", "1")
+		if self.affinity:
+			assert self.engine == "tyrant", "Affinity needs the tyrant engine"
+			weights = eval(str(config["server_weights"]))
+			self.affinityWorkers = dict((sID, 1 if weights.get(sID, 1) > 0 else 0) for sID in self.databases.keys())
+			self.affinityWorkers.update(eval(str(config["affinity_workers"])))
+			assert sum(self.affinityWorkers.values()) > 0, "Invalid affinity_workers '%s'" % config["affinity_workers"]
+		## IF
+
+	## ----------------------------------------------
+	## openTable
+	## ----------------------------------------------
+	def openTable(self, config, serverId, tableName, values):
+		"""Returns the connection pool of one server's table. The embedded
+		   engine opens a single shared handle instead, and keeps each
+		   server's tables in their own directory of data_dir"""
+		if self.engine == "tyrant":
+			return ConnectionPool(values["host"], values["port"], self.poolSize, self.poolCheckInterval, self.readThreads)
+
+		path = os.path.join(config["data_dir"], str(serverId))
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		return EmbeddedTable(os.path.join(path, "%s.tct" % tableName.lower()))
+
 	## -------------------------------------------
 	## loadTuples
 	## -------------------------------------------
@@ -280,7 +1922,8 @@ class TokyocabinetDriver(AbstractDriver):
 		   Each table is a connection to a Tyrant server. Each record is a key-value pair,
 		   where key = primary key, values = concatenation of columns (dictionary). If
 		   key is compound we transform it into a string, since TC does not support
-		   compound keys. Data partitioning occurs based on Warehouse ID."""
+		   compound keys. Data partitioning occurs based on Warehouse ID: records are
+		   grouped by server, split into batches and sent to all servers concurrently."""
 
 		if len(tuples) == 0: return
 
@@ -288,190 +1931,404 @@ class TokyocabinetDriver(AbstractDriver):
 
 		assert tableName in TABLE_COLUMNS, "Unexpected table %s" % tableName
 		columns = TABLE_COLUMNS[tableName]
-		num_columns = xrange(len(columns))
-		records = list()
+		key_columns = [columns.index(c) for c in TABLE_KEYS[tableName]]
+		counters = TABLE_COUNTERS.get(tableName, [ ])
+		partition = TABLE_PARTITION_COLUMNS[tableName]
 
-		if tableName == constants.TABLENAME_WAREHOUSE:
+		serverRecords = dict()
+
+		## Item table doesn't have a w_id for partition. Replicate it to all
+		## servers
+		if partition == None:
+			records = list()
 			for t in tuples:
-				w_key = t[0] # W_ID
-				sID = self.getServer(w_key)
-				cols = dict(map(lambda i: (columns[i], t[i]), num_columns))
-				records.append((str(w_key), cols))
+				key = self.tupleToString([t[i] for i in key_columns])
+				records.append((key, self.compressColumns(dict(zip(columns, t)))))
 			## FOR
-
-			try:
-				self.conn[sID][tableName].multi_set(records)
-			except KeyError, err:
-				sys.stderr.write("%s(%s): server ID does not exist or is offline\n" %(KeyError, err))
-				sys.exit(1)
-
-		elif tableName == constants.TABLENAME_DISTRICT:
+			for sID in self.conn.keys():
+				serverRecords[sID] = records
+		else:
+			w_column = columns.index(partition)
 			for t in tuples:
-				w_key = t[1] # W_ID
-				sID = self.getServer(w_key)
-				d_key = self.tupleToString(t[:2]) # D_ID, D_W_ID
-				cols = dict(map(lambda i: (columns[i], t[i]), num_columns))
-				records.append((d_key, cols))
+				sID = self.getServer(t[w_column])
+				key = [t[i] for i in key_columns]
+				cols = self.compressColumns(dict(zip(columns, t)))
+				records = serverRecords.setdefault(sID, list())
+				# Counters go to their own records (the "_num" column is
+				# where Tokyo Cabinet keeps addint/adddouble values)
+				for column in counters:
+					records.append((self.counterKey(column, key), {"_num": cols.pop(column)}))
+				if tableName in self.splitTables:
+					hot, cold = self.splitTables[tableName]
+					rowKey = self.recordKey(tableName, key)
+					records.append((rowKey, dict((c, v) for c, v in cols.iteritems() if c in hot)))
+					records.append((self.coldKey(rowKey), dict((c, v) for c, v in cols.iteritems() if c in cold)))
+				else:
+					records.append((self.recordKey(tableName, key), cols))
 			## FOR
+		## IF
 
-			try:
-				self.conn[sID][tableName].multi_set(records)
-			except KeyError, err:
-				sys.stderr.write("%s(%s): server ID does not exist or is offline\n" %(KeyError, err))
-				sys.exit(1)
-
-		## Item table doesn't have a w_id for partition. Replicate it to all
-		## servers
-		elif tableName == constants.TABLENAME_ITEM:
+		## Last names never change, so the C_LAST lists are built once all
+		## customers are loaded (see loadNameIndex)
+		if tableName == constants.TABLENAME_CUSTOMER:
+			c_id, c_d_id, c_w_id, c_first, c_last = [columns.index(c) for c in ("C_ID", "C_D_ID", "C_W_ID", "C_FIRST", "C_LAST")]
 			for t in tuples:
-				i_key = str(t[0])
-				cols = dict(map(lambda i: (columns[i], t[i]), num_columns))
-				records.append((i_key, cols))
+				self.nameIndex.setdefault((t[c_w_id], t[c_d_id], t[c_last]), list()).append((t[c_first], t[c_id]))
 			## FOR
+		## IF
 
-			for i in xrange(self.numServers):
-				try:
-					self.conn[i][tableName].multi_set(records)
-				except KeyError, err:
-					sys.stderr.write("%s(%s): server ID doesn't exist or is offline\n" %(KeyError, err))
-					sys.exit(1)
-				## FOR
+		## Orders may arrive in any order, so the last order of each customer
+		## is stored once everything is loaded (see loadLastOrders)
+		if tableName == constants.TABLENAME_ORDERS:
+			o_id, o_c_id, o_d_id, o_w_id = [columns.index(c) for c in ("O_ID", "O_C_ID", "O_D_ID", "O_W_ID")]
+			for t in tuples:
+				key = (t[o_w_id], t[o_d_id], t[o_c_id])
+				self.lastOrders[key] = max(self.lastOrders.get(key, t[o_id]), t[o_id])
 			## FOR
+		## IF
 
-		elif tableName == constants.TABLENAME_CUSTOMER:
+		## A district's new order queue starts at its oldest new order, or at
+		## D_NEXT_O_ID if it has none (see loadQueueHeads). Ordered tables
+		## need no queue heads
+		if tableName in (constants.TABLENAME_DISTRICT, constants.TABLENAME_NEW_ORDER) and \
+				not constants.TABLENAME_NEW_ORDER in self.keyCodecs:
+			if tableName == constants.TABLENAME_DISTRICT:
+				o_id, d_id, w_id = [columns.index(c) for c in ("D_NEXT_O_ID", "D_ID", "D_W_ID")]
+			else:
+				o_id, d_id, w_id = [columns.index(c) for c in ("NO_O_ID", "NO_D_ID", "NO_W_ID")]
 			for t in tuples:
-				w_key = t[2] # W_ID
-				sID = self.getServer(w_key)
-				c_key = self.tupleToString(t[:3]) # C_ID, C_D_ID, C_W_ID
-				cols = dict(map(lambda i: (columns[i], t[i]), num_columns))
-				records.append((c_key, cols))
+				key = (t[w_id], t[d_id])
+				self.queueHeads[key] = min(self.queueHeads.get(key, t[o_id]), t[o_id])
 			## FOR
+		## IF
 
-			try:
-				self.conn[sID][tableName].multi_set(records)
-			except KeyError, err:
-				sys.stderr.write("%s(%s): server ID does not exist or is offline\n" %(KeyError, err))
+		for sID in serverRecords.keys():
+			if not sID in self.conn:
+				sys.stderr.write("%s(%s): server ID does not exist or is offline\n" %(KeyError, sID))
 				sys.exit(1)
+		## FOR
 
-		elif tableName == constants.TABLENAME_HISTORY:
-			for t in tuples:
-				w_key = t[4] # W_ID
-				# Not really a primary key, but we need to generate
-				# something tobe our key
-				h_key = self.tupleToString(t[:3]) # H_C_ID, H_C_D, H_C_W
-				sID = self.getServer(w_key)
-				cols = dict(map(lambda i: (columns[i], t[i]), num_columns))
-				records.append((h_key, cols))
-			## FOR
+		self.parallelMap(lambda (sID, records): self.loadRecords(sID, tableName, records), serverRecords.items())
 
-			try:
-				self.conn[sID][tableName].multi_set(records)
-			except KeyError, err:
-				sys.stderr.write("%s(%s): server ID does not exist or is offline\n" %(KeyError, err))
-				sys.exit(1)
+		logging.debug("Loaded %s tuples for tableName %s" % (len(tuples), tableName))
+		return
 
-		elif tableName == constants.TABLENAME_STOCK:
-			for t in tuples:
-				w_key = t[1] # W_ID
-				sID = self.getServer(w_key)
-				s_key = self.tupleToString(t[:2]) # S_ID, S_W_ID
-				cols = dict(map(lambda i: (columns[i], t[i]), num_columns))
-				records.append((s_key, cols))
-			## FOR
+	## -------------------------------------------
+	## compressColumns
+	## -------------------------------------------
+	def compressColumns(self, cols):
+		"""Compresses the compress_columns values of a column dictionary, in
+		   place, and returns it"""
+		for column in self.compressedColumns:
+			if column in cols:
+				cols[column] = self.compressor.compress(str(cols[column]))
+		## FOR
+		return cols
 
-			try:
-				self.conn[sID][tableName].multi_set(records)
-			except KeyError, err:
-				sys.stderr.write("%s(%s): server ID does not exist or is offline\n" %(KeyError, err))
-				sys.exit(1)
+	## -------------------------------------------
+	## loadRecords
+	## -------------------------------------------
+	def loadRecords(self, sID, tableName, records):
+		"""Stores records in one server's table, batchSize records per
+		   multi_set call"""
+		for i in xrange(0, len(records), self.batchSize):
+			self.conn[sID][tableName].multi_set(records[i:i+self.batchSize])
+		## FOR
 
-		elif tableName == constants.TABLENAME_ORDERS:
-			for t in tuples:
-				w_key = t[3] # W_ID
-				sID = self.getServer(w_key)
-				o_key = self.tupleToString(t[1:4]) # O_ID, O_D_ID, O_W_ID
-				cols = dict(map(lambda i: (columns[i], t[i]), num_columns))
-				records.append((o_key, cols))
-			## FOR
+	## -------------------------------------------
+	## loadFinish
+	## -------------------------------------------
+	def loadFinish(self):
+
+		self.loadNameIndex()
+		self.loadLastOrders()
+		self.loadQueueHeads()
+
+		logging.info("Creating, optimizing and syncing indexes...")
+		# Add indexes to database after loading all data. Every (server, table)
+		# pair has its own connection, so they can all be built concurrently
+		tasks = list()
+		for sID, tables in self.conn.iteritems():
+			for tab in tables.keys():
+				tasks.append((sID, tab))
+		## FOR
+		self.parallelMap(lambda (sID, tab): self.buildIndexes(sID, tab), tasks)
+
+		logging.info("Finished loading tables")
+
+	## -------------------------------------------
+	## loadNameIndex
+	## -------------------------------------------
+	def loadNameIndex(self):
+		"""Stores the C_LAST lists of the customers this driver loaded in the
+		   CUSTOMER table of their warehouse's server (see nameIndexKey)"""
+		logging.info("Creating last name index for %d names" % len(self.nameIndex))
+		serverRecords = dict()
+		for (w_id, d_id, c_last), customers in self.nameIndex.iteritems():
+			c_ids = " ".join(str(c_id) for c_first, c_id in sorted(customers))
+			serverRecords.setdefault(self.getServer(w_id), list()).append((self.nameIndexKey(w_id, d_id, c_last), {"C_IDS": c_ids}))
+		## FOR
+		self.parallelMap(lambda (sID, records): self.loadRecords(sID, constants.TABLENAME_CUSTOMER, records), serverRecords.items())
+		self.nameIndex = dict()
+
+	## -------------------------------------------
+	## loadLastOrders
+	## -------------------------------------------
+	def loadLastOrders(self):
+		"""Stores the last order pointers of the customers this driver loaded
+		   in the ORDERS table of their warehouse's server (see lastOrderKey)"""
+		logging.info("Creating last order pointers for %d customers" % len(self.lastOrders))
+		serverRecords = dict()
+		for (w_id, d_id, c_id), o_id in self.lastOrders.iteritems():
+			serverRecords.setdefault(self.getServer(w_id), list()).append((self.lastOrderKey(w_id, d_id, c_id), {"O_ID": o_id}))
+		## FOR
+		self.parallelMap(lambda (sID, records): self.loadRecords(sID, constants.TABLENAME_ORDERS, records), serverRecords.items())
+		self.lastOrders = dict()
+
+	## -------------------------------------------
+	## loadQueueHeads
+	## -------------------------------------------
+	def loadQueueHeads(self):
+		"""Stores the new order queue heads of the districts this driver
+		   loaded in the NEW_ORDER table of their warehouse's server (see
+		   popNewOrders)"""
+		logging.info("Creating new order queue heads for %d districts" % len(self.queueHeads))
+		serverRecords = dict()
+		for (w_id, d_id), no_o_id in self.queueHeads.iteritems():
+			serverRecords.setdefault(self.getServer(w_id), list()).append((self.counterKey("NO_O_ID", (d_id, w_id)), {"_num": no_o_id}))
+		## FOR
+		self.parallelMap(lambda (sID, records): self.loadRecords(sID, constants.TABLENAME_NEW_ORDER, records), serverRecords.items())
+		self.queueHeads = dict()
+
+	## -------------------------------------------
+	## buildIndexes
+	## -------------------------------------------
+	def buildIndexes(self, sID, tableName):
+		"""Creates and optimizes the indexes TABLE_INDEXES plans for one
+		   server's table, then flushes the table to disk"""
+		proto = self.conn[sID][tableName].proto
+		## B+tree databases have no column indexes
+		indexes = TABLE_INDEXES.get(tableName, [ ]) if not tableName in self.keyCodecs else [ ]
+		for index_name in indexes:
+			logging.debug("Creating %s index %s at server '%s'" % (INDEX_TYPES[COLUMN_TYPES[index_name]], index_name, sID))
+			proto.add_index(index_name, INDEX_TYPES[COLUMN_TYPES[index_name]])
+			proto.optimize_index(index_name)
+		## FOR
+		proto.sync()
 
-			try:
-				self.conn[sID][tableName].multi_set(records)
-			except KeyError, err:
-				sys.stderr.write("%s(%s): server ID does not exist or is offline\n" %(KeyError, err))
-				sys.exit(1)
+	## -------------------------------------------
+	## executeStart
+	## -------------------------------------------
+	def executeStart(self):
+		if self.itemCacheMode == "bulk":
+			self.loadItemCache(min(self.conn.keys()))
+			self.releaseConnections()
+		if self.affinity:
+			self.assignHomeServer()
 
-		elif tableName == constants.TABLENAME_NEW_ORDER:
-			for t in tuples:
-				w_key = t[2] # W_ID
-				sID = self.getServer(w_key)
-				no_key = self.tupleToString(t[:3]) # NO_O_ID, NO_D_ID, NO_W_ID
-				cols = dict(map(lambda i: (columns[i], t[i]), num_columns))
-				records.append((no_key, cols))
-			## FOR
-				
-			try:
-				self.conn[sID][tableName].multi_set(records)
-			except KeyError, err:
-				sys.stderr.write("%s(%s): server ID does not exist or is offline\n" %(KeyError, err))
-				sys.exit(1)
+	## -------------------------------------------
+	## executeFinish
+	## -------------------------------------------
+	def executeFinish(self):
+		if self.homeServer != None:
+			self.reportAffinity()
 
-		elif tableName == constants.TABLENAME_ORDER_LINE:
-			for t in tuples:
-				w_key = t[2] # W_ID
-				sID = self.getServer(w_key)
-				ol_key = self.tupleToString(t[:4]) # OL_O_ID, OL_D_ID, OL_W_ID, OL_NUMBER
-				cols = dict(map(lambda i: (columns[i], t[i]), num_columns))
-				records.append((ol_key, cols))
-			## FOR
-				
-			try:
-				self.conn[sID][tableName].multi_set(records)
-			except KeyError, err:
-				sys.stderr.write("%s(%s): server ID does not exist or is offline\n" %(KeyError, err))
-				sys.exit(1)
+	## -------------------------------------------
+	## executeTransaction
+	## -------------------------------------------
+	def executeTransaction(self, txn, params):
+		"""With affinity, moves the transaction to a warehouse of the home
+		   server before running it"""
+		if self.homeServer != None:
+			self.localizeParams(params)
+		return super(TokyocabinetDriver, self).executeTransaction(txn, params)
 
-		logging.debug("Loaded %s tuples for tableName %s" % (len(tuples), tableName))
-		return
+	## -------------------------------------------
+	## assignHomeServer
+	## -------------------------------------------
+	def assignHomeServer(self):
+		"""Picks the server this client process works on. Processes number
+		   themselves with the "AFFINITY" counter of the first server's ITEM
+		   table and go round the servers, affinity_workers at a time. The
+		   pools of the other servers are cut to what the reader threads
+		   need (see runConcurrently), so the connections of all clients
+		   grow linearly with the servers"""
+		slots = [sID for sID in sorted(self.conn.keys()) for i in xrange(self.affinityWorkers.get(sID, 0))]
+		worker = self.conn[min(self.conn.keys())][constants.TABLENAME_ITEM].proto.addint("AFFINITY", 1) - 1
+		self.homeServer = slots[worker % len(slots)]
+
+		## The home server's warehouses are the rows of its WAREHOUSE table
+		## (its other records are counters, whose keys are not numbers)
+		keys = self.conn[self.homeServer][constants.TABLENAME_WAREHOUSE].proto.fwmkeys("")
+		self.homeWarehouses = sorted(int(k) for k in keys if k.isdigit() and self.getServer(int(k)) == self.homeServer)
+		assert len(self.homeWarehouses) > 0, "Server '%s' has no warehouses" % self.homeServer
+		self.releaseConnections()
+
+		for sID, tables in self.conn.iteritems():
+			if sID == self.homeServer: continue
+			for pool in tables.itervalues():
+				pool.size = min(self.poolSize, self.readThreads)
+		## FOR
+		self.affinityStats = { "transactions": 0, "stock lines": dict(), "payment customers": dict() }
+		logging.info("Client process %d works on server '%s'" % (worker, self.homeServer))
 
 	## -------------------------------------------
-	## loadFinish
+	## homeWarehouse
 	## -------------------------------------------
-	def loadFinish(self):
+	def homeWarehouse(self, w_id):
+		"""Returns w_id if it is on the home server, or else one of the home
+		   server's warehouses drawn uniformly, so that all of them are
+		   equally likely whatever the partitioner. Warehouses moved away
+		   since the start are dropped from the list"""
+		if self.getServer(w_id) == self.homeServer:
+			return w_id
+		while True:
+			other = random.choice(self.homeWarehouses)
+			if self.getServer(other) == self.homeServer:
+				return other
+			self.homeWarehouses.remove(other)
+			assert len(self.homeWarehouses) > 0, "Server '%s' has no warehouses left" % self.homeServer
+		## WHILE
 
-		conn = dict()
+	## -------------------------------------------
+	## localizeParams
+	## -------------------------------------------
+	def localizeParams(self, params):
+		"""Replaces the home warehouse of a transaction's parameters with one
+		   of the home server. Stock lines and Payment customers of the
+		   home warehouse follow it; remote ones stay where they are, and
+		   are counted per server for reportAffinity"""
+		w_id = params["w_id"]
+		home = self.homeWarehouse(w_id)
+		params["w_id"] = home
+		self.affinityStats["transactions"] += 1
+		if "i_w_ids" in params:
+			params["i_w_ids"] = [home if i_w_id == w_id else i_w_id for i_w_id in params["i_w_ids"]]
+			for i_w_id in params["i_w_ids"]:
+				self.countAccess("stock lines", i_w_id)
+		## IF
+		if "c_w_id" in params:
+			if params["c_w_id"] == w_id:
+				params["c_w_id"] = home
+			self.countAccess("payment customers", params["c_w_id"])
+		## IF
 
-		logging.info("Creating indexes...")
-		# Add indexes to database after loading all data
-		for serverId, tables in self.databases.iteritems():
-			conn[serverId] = dict()
-			for tab, connValues in tables.iteritems():
-				conn[serverId][tab] = protocol.TyrantProtocol(connValues["host"], connValues["port"])
-				for index_name in TABLE_COLUMNS[tab]:
-					conn[serverId][tab].add_index(index_name)
-			## FOR
+	def countAccess(self, kind, w_id):
+		counts = self.affinityStats[kind]
+		sID = self.getServer(w_id)
+		counts[sID] = counts.get(sID, 0) + 1
+
+	## -------------------------------------------
+	## reportAffinity
+	## -------------------------------------------
+	def reportAffinity(self):
+		"""Logs the cross-server traffic left with affinity: the stock lines
+		   and Payment customers of warehouses on other servers"""
+		logging.info("Server '%s': %d transactions" % (self.homeServer, self.affinityStats["transactions"]))
+		for kind in ("stock lines", "payment customers"):
+			counts = self.affinityStats[kind]
+			total = sum(counts.values())
+			remote = total - counts.get(self.homeServer, 0)
+			others = dict((sID, n) for sID, n in counts.iteritems() if sID != self.homeServer)
+			logging.info("Remote %s: %d of %d (%.1f%%), by server %s" % (kind, remote, total,
+					100.0 * remote / max(1, total), others))
 		## FOR
 
-		logging.info("Optimizing indexes...")
-		# Optimize indexes for faster access
-		for serverId, tables in self.databases.iteritems():
-			for tab, connValues in tables.iteritems():
-				for index_name in TABLE_COLUMNS[tab]:
-					conn[serverId][tab].optimize_index(index_name)
+	## -------------------------------------------
+	## loadItemCache
+	## -------------------------------------------
+	def loadItemCache(self, sID):
+		"""Reads the whole (immutable) ITEM table from the given server into
+		   the driver-side item cache"""
+		logging.info("Loading ITEM cache from server '%s'" % sID)
+		self.itemCache = dict()
+		for first in xrange(1, constants.NUM_ITEMS+1, self.batchSize):
+			i_ids = range(first, min(first+self.batchSize, constants.NUM_ITEMS+1))
+			for i_id, item in zip(i_ids, self.getRows(sID, constants.TABLENAME_ITEM, [(i,) for i in i_ids])):
+				if item != None:
+					self.itemCache[i_id] = (item.I_PRICE, item.I_NAME, item.I_DATA)
 			## FOR
 		## FOR
+		logging.info("Cached %d items" % len(self.itemCache))
 
-		logging.info("Syncing to disk...")
-		# Finally, flush everything to disk
-		for tab in TABLE_COLUMNS.keys():
-			for sID in self.conn.keys():
-				self.conn[sID][tab].sync()
+	## -------------------------------------------
+	## updateStocks
+	## -------------------------------------------
+	def updateStocks(self, sID, w_id, lines):
+		"""Applies the stock updates of NewOrder lines supplied by one
+		   server: lines are (i_id, supply_w_id, quantity) tuples and w_id is
+		   the home warehouse. All stock rows are read in one round trip, and
+		   the changes of S_QUANTITY, S_YTD, S_ORDER_CNT and S_REMOTE_CNT are
+		   added to them on the server in another, so concurrent NewOrders
+		   on the same items keep each other's updates (whether S_QUANTITY
+		   is restocked is decided on the quantity read). Returns the updated
+		   rows, or None for lines without a stock row"""
+		stocks = self.getRows(sID, constants.TABLENAME_STOCK, [(i_id, supply_w_id) for i_id, supply_w_id, quantity in lines])
+		columns = ["S_QUANTITY", "S_YTD", "S_ORDER_CNT", "S_REMOTE_CNT"]
+		## An item ordered twice is updated twice: later lines start from
+		## the row left by the earlier ones
+		updated = dict()
+		keys = [ ]
+		increments = [ ]
+		result = [ ]
+		for (i_id, supply_w_id, quantity), stockInfo in zip(lines, stocks):
+			if stockInfo == None:
+				result.append(None)
+				continue
+			stockInfo = updated.setdefault((i_id, supply_w_id), stockInfo.copy())
+			if stockInfo.S_QUANTITY >= quantity + 10:
+				restock = -quantity
+			else:
+				restock = 91 - quantity
+			increment = (restock, quantity, 1, 1 if supply_w_id != w_id else 0)
+			for column, v in zip(columns, increment):
+				stockInfo[column] += v
+			keys.append((i_id, supply_w_id))
+			increments.append(increment)
+			result.append(stockInfo.copy())
 		## FOR
-				
-		logging.info("Finished loading tables")
+		if len(keys) > 0:
+			self.addColumns(sID, constants.TABLENAME_STOCK, keys, columns, increments)
+		return result
+
+	## -------------------------------------------
+	## getItems
+	## -------------------------------------------
+	def getItems(self, sID, i_ids):
+		"""Returns a (I_PRICE, I_NAME, I_DATA) tuple for each item id, or None
+		   for ids that do not exist. Items are served from the driver-side
+		   cache; only the ids it is missing are read from the server"""
+		if self.itemCacheMode == "bulk":
+			## A complete cache knows every valid item, so misses are the 1%
+			## of invalid ids and need no round trip
+			if self.itemCache == None: self.loadItemCache(sID)
+			return [self.itemCache.get(i_id) for i_id in i_ids]
+
+		cache = self.itemCache if self.itemCache != None else dict()
+		missing = list(set(i_id for i_id in i_ids if not i_id in cache))
+		if len(missing) == 0:
+			return [cache[i_id] for i_id in i_ids]
+
+		fetched = dict()
+		for i_id, item in zip(missing, self.getRows(sID, constants.TABLENAME_ITEM, [(i,) for i in missing])):
+			if item != None:
+				fetched[i_id] = (item.I_PRICE, item.I_NAME, item.I_DATA)
+		## FOR
+		items = [cache.get(i_id, fetched.get(i_id)) for i_id in i_ids]
+
+		## Bounded cache: evict arbitrary entries to make room
+		if self.itemCache != None and self.itemCacheSize > 0:
+			for i_id, item in fetched.iteritems():
+				if len(self.itemCache) >= self.itemCacheSize:
+					self.itemCache.popitem()
+				self.itemCache[i_id] = item
+			## FOR
+		return items
 
 	## --------------------------------------------
 	## doDelivery
 	## --------------------------------------------
+	@pooled
 	def doDelivery(self, params):
 		"""Execute DELIVERY Transaction
 		Parameters Dict:
@@ -479,6 +2336,7 @@ class TokyocabinetDriver(AbstractDriver):
 			o_carrier_id
 			ol_delivery_id
 		"""
+		if self.useProcedures: return self.doDeliveryProcedures(params)
 
 		w_id = params["w_id"]
 		o_carrier_id = params["o_carrier_id"]
@@ -486,99 +2344,70 @@ class TokyocabinetDriver(AbstractDriver):
 
 		sID = self.getServer(w_id)
 
-		newOrderQuery = self.conn[sID][constants.TABLENAME_NEW_ORDER].query
-		ordersQuery   = self.conn[sID][constants.TABLENAME_ORDERS].query
-		orderLineQuery = self.conn[sID][constants.TABLENAME_ORDER_LINE].query
-		customerQuery = self.conn[sID][constants.TABLENAME_CUSTOMER].query
-
-		results = [ ]
-		for d_id in xrange(1, constants.DISTRICTS_PER_WAREHOUSE+1):
-
-			# getNewOrder
-			# SELECT NO_O_ID FROM NEW_ORDER WHERE NO_D_ID = ? AND NO_W_ID = ? AND NO_O_ID > -1 LIMIT 1
-			
-			newOrders = newOrderQuery.filter(NO_D_ID = d_id, NO_W_ID = w_id, NO_O_ID__gt = -1).columns("NO_O_ID")
-			if len(newOrders) == 0:
-				## No orders for this district: skip it. Note: This must
-				## reported if > 1%
-				continue
-			assert(newOrders) > 0
-			no_o_id = int(newOrders[0]["NO_O_ID"])
-
-			# sumOLAmount
-			# SELECT SUM(OL_AMOUNT) FROM ORDER_LINE WHERE OL_O_ID = ? AND OL_D_ID = ? AND OL_W_ID = ?
-
-			olines = orderLineQuery.filter(OL_O_ID = no_o_id, OL_D_ID = d_id, OL_W_ID = w_id).columns("OL_AMOUNT")
+		## Delivery runs in phases, each one a single round trip covering
+		## all districts
 
-			# These must be logged in the "result file" according to TPC-C 
-			# 2.7.22 (page 39)
-			# We remove the queued time, completed time, w_id, and 
-			# o_carrier_id: the client can figure them out
-			# If there are no order lines, SUM returns null. There should
-			# always be order lines.
-			assert len(olines) > 0, "ol_total is NULL: there are no order lines. This should not happen"
+		# getNewOrder, deleteNewOrder
+		# SELECT NO_O_ID FROM NEW_ORDER WHERE NO_D_ID = ? AND NO_W_ID = ? AND NO_O_ID > -1 LIMIT 1
+		# DELETE FROM NEW_ORDER WHERE NO_D_ID = ? AND NO_W_ID = ? AND NO_O_ID = ?
 
-			ol_total = sum(float(i["OL_AMOUNT"]) for i in olines)
+		d_ids = range(1, constants.DISTRICTS_PER_WAREHOUSE+1)
+		## Districts without orders are skipped. Note: This must be
+		## reported if > 1%
+		results = [(d_id, no_o_id) for d_id, no_o_id in zip(d_ids, self.popNewOrders(sID, w_id, d_ids)) if no_o_id != None]
+		if len(results) == 0:
+			return results
 
-			assert ol_total > 0.0
+		# HACK: not transactionally safe
+		# getCId
+		# SELECT O_C_ID FROM ORDERS WHERE O_ID = ? AND O_D_ID = ? AND O_W_ID = ?
 
-			# deleteNewOrder
-			# DELETE FROM NEW_ORDER WHERE NO_D_ID = ? AND NO_W_ID = ? AND NO_O_ID = ?
+		o_keys = [(no_o_id, d_id, w_id) for d_id, no_o_id in results]
+		orders = self.getRows(sID, constants.TABLENAME_ORDERS, o_keys)
+		assert not None in orders
 
-			orders = newOrderQuery.filter(NO_D_ID = d_id, NO_W_ID = w_id, NO_O_ID = no_o_id)
-			orders.delete(quick=True)
+		# sumOLAmount
+		# SELECT SUM(OL_AMOUNT) FROM ORDER_LINE WHERE OL_O_ID = ? AND OL_D_ID = ? AND OL_W_ID = ?
 
-			# HACK: not transactionally safe
-			# getCId
-			# SELECT O_C_ID FROM ORDERS WHERE O_ID = ? AND O_D_ID = ? AND O_W_ID = ?
-
-			orders = ordersQuery.filter(O_ID = no_o_id, O_D_ID = d_id, O_W_ID = w_id)
-			assert len(orders) > 0
-			c_id = int(orders.columns("O_C_ID")[0]["O_C_ID"])
-
-			# updateOrders
-			# UPDATE ORDERS SET O_CARRIER_ID = ? WHERE O_ID = ? AND O_D_ID = ? AND O_W_ID = ?
-
-			records = list()
-			for record in orders:
-				key, cols = record
-				cols["O_CARRIER_ID"] = o_carrier_id
-				records.append((key, cols))
-			## FOR
+		ol_keys = [ ]
+		ol_cnts = [order.O_OL_CNT for order in orders]
+		for (no_o_id, d_id, o_w_id), ol_cnt in zip(o_keys, ol_cnts):
+			ol_keys.extend((no_o_id, d_id, o_w_id, ol_number) for ol_number in xrange(1, ol_cnt+1))
+		## FOR
+		ol_totals = [float(t) for t in self.aggregate(sID, constants.TABLENAME_ORDER_LINE, "sumcols", ol_keys, "OL_AMOUNT", ol_cnts)]
 
-			self.conn[sID][constants.TABLENAME_ORDERS].multi_set(records)
+		# These must be logged in the "result file" according to TPC-C
+		# 2.7.22 (page 39)
+		# We remove the queued time, completed time, w_id, and
+		# o_carrier_id: the client can figure them out
+		# If there are no order lines, SUM returns null. There should
+		# always be order lines.
+		assert all(t > 0.0 for t in ol_totals), "ol_total is NULL: there are no order lines. This should not happen"
 
-			# updateOrderLine
-			# UPDATE ORDER_LINE SET OL_DELIVERY_D = ? WHERE OL_O_ID = ? AND OL_D_ID = ? AND OL_W_ID = ?
+		# updateOrders
+		# UPDATE ORDERS SET O_CARRIER_ID = ? WHERE O_ID = ? AND O_D_ID = ? AND O_W_ID = ?
 
-			orders = orderLineQuery.filter(OL_O_ID = no_o_id, OL_D_ID = d_id, OL_W_ID = w_id)
-			records = list()
-			for record in orders:
-				key, cols = record
-				cols["OL_DELIVERY_D"] = ol_delivery_d
-				records.append((key, cols))
-			## FOR
+		self.updateRecords(sID, constants.TABLENAME_ORDERS, o_keys, {"O_CARRIER_ID": o_carrier_id})
 
-			self.conn[sID][constants.TABLENAME_ORDER_LINE].multi_set(records)
+		# updateOrderLine
+		# UPDATE ORDER_LINE SET OL_DELIVERY_D = ? WHERE OL_O_ID = ? AND OL_D_ID = ? AND OL_W_ID = ?
 
-			# updateCustomer
-			# UPDATE CUSTOMER SET C_BALANCE = C_BALANCE + ? WHERE C_ID = ? AND C_D_ID = ? AND C_W_ID = ?
+		self.updateRecords(sID, constants.TABLENAME_ORDER_LINE, ol_keys, {"OL_DELIVERY_D": ol_delivery_d})
 
-			customers = customerQuery.filter(C_ID = c_id, C_D_ID = d_id, C_W_ID = w_id)
-			records = list()
-			for record in customers:
-				key, cols = record
-				cols["C_BALANCE"] = float(cols["C_BALANCE"]) + ol_total
-				records.append((key, cols))
-			## FOR
+		# updateCustomer
+		# UPDATE CUSTOMER SET C_BALANCE = C_BALANCE + ?, C_DELIVERY_CNT = C_DELIVERY_CNT + 1
+		#	WHERE C_ID = ? AND C_D_ID = ? AND C_W_ID = ?
 
-			self.conn[sID][constants.TABLENAME_CUSTOMER].multi_add(records)
-		
-			results.append((d_id, no_o_id))
-		## FOR
+		## The customers are not read: the server adds to their columns, so
+		## a concurrent Payment's changes are kept
+		c_keys = [(order.O_C_ID, o_key[1], w_id) for o_key, order in zip(o_keys, orders)]
+		self.addColumns(sID, constants.TABLENAME_CUSTOMER, c_keys, ["C_BALANCE", "C_DELIVERY_CNT"],
+				[(ol_total, 1) for ol_total in ol_totals])
 
 		return results
 
+	@pooled
+	@abortable
 	def doNewOrder(self, params):
 		"""Execute NEW_ORDER Transaction
 		Parameters Dict:
@@ -590,6 +2419,7 @@ class TokyocabinetDriver(AbstractDriver):
 			i_w_ids
 			i_qtys
 		"""
+		if self.useProcedures: return self.doNewOrderProcedures(params)
 
 		w_id = params["w_id"]
 		d_id = params["d_id"]
@@ -605,30 +2435,21 @@ class TokyocabinetDriver(AbstractDriver):
 
 		sID = self.getServer(w_id)
 
-		warehouseQuery = self.conn[sID][constants.TABLENAME_WAREHOUSE].query
-		districtQuery  = self.conn[sID][constants.TABLENAME_DISTRICT].query
-		customerQuery  = self.conn[sID][constants.TABLENAME_CUSTOMER].query
-		orderQuery = self.conn[sID][constants.TABLENAME_ORDERS].query
-		newOrderQuery = self.conn[sID][constants.TABLENAME_NEW_ORDER].query
-		itemQuery = self.conn[sID][constants.TABLENAME_ITEM].query
-
 		all_local = True
-		items = [ ]
 		for i in xrange(len(i_ids)):
 			## Determine if this is an all local order or not
 			all_local = all_local and i_w_ids[i] == w_id
-			# getItemInfo
-			retItems = itemQuery.filter(I_PRICE = i_ids[i])
-			if len(items) > 0:
-				items.append(retItems.columns())
-			else:
-				items.append([])
+		## FOR
+
+		# getItemInfo
+		# SELECT I_PRICE, I_NAME, I_DATA FROM ITEM WHERE I_ID = ?
+		items = self.getItems(sID, i_ids)
 		assert len(items) == len(i_ids)
 
 		## TPCC define 1% of neworder gives a wrong itemid, causing rollback.
 		## Note that this will happen with 1% of transactions on purpose.
 		for item in items:
-			if len(item) == 0:
+			if item == None:
 				## TODO Abort here!
 				return
 		## FOR
@@ -636,39 +2457,33 @@ class TokyocabinetDriver(AbstractDriver):
 		## -----------------
 		## Collect Information from WAREHOUSE, DISTRICT, and CUSTOMER
 		## -----------------
-		
+
+		## These do not depend on each other and run concurrently. The order
+		## id is only taken once the items are known to be valid, so aborted
+		## transactions leave no gaps in the new order queues
+
 		# getWarehouseTaxRate
 		# SELECT W_TAX FROM WAREHOUSE WHERE W_ID = ?
 
-		taxes = warehouseQuery.filter(W_ID = w_id)
-		w_tax = float(taxes.columns("W_TAX")[0]["W_TAX"])
-
 		# getDistrict
 		# SELECT D_TAX, D_NEXT_O_ID FROM DISTRICT WHERE D_ID = ? AND D_W_ID = ?
 
-		districts = districtQuery.filter(D_ID = d_id, D_W_ID = w_id)
-		districtInfo = districts.columns("D_TAX", "D_NEXT_O_ID")[0]
-		d_tax = float(districtInfo["D_TAX"])
-		d_next_o_id = int(districtInfo["D_NEXT_O_ID"])
-
 		# incrementNextOrderId
-		# HACK: This is not transactionally safe!
 		# UPDATE DISTRICT SET D_NEXT_O_ID = ? WHERE D_ID = ? AND D_W_ID = ?
-		records = list()
-		for record in districts:
-			key, cols = record
-			cols["D_NEXT_O_ID"] = d_next_o_id + 1
-			records.append((key, cols))
-		## FOR
-
-		self.conn[sID][constants.TABLENAME_DISTRICT].multi_set(records)
 
 		# getCustomer
 		# SELECT C_DISCOUNT, C_LAST, C_CREDIT FROM CUSTOMER WHERE C_W_ID = ? AND C_D_ID = ? AND C_ID = ?
 
-		customers = customerQuery.filter(C_W_ID = w_id, C_D_ID = d_id, C_ID = c_id)
-		customerInfo = customers.columns("C_DISCOUNT", "C_LAST", "C_CREDIT")[0]
-		c_discount = float(customerInfo["C_DISCOUNT"])
+		d_key = (d_id, w_id)
+		pending = self.pendingOrders.orders
+		warehouseInfo, districtInfo, d_next_o_id, customerInfo = self.concurrently(
+			lambda: self.getRow(sID, constants.TABLENAME_WAREHOUSE, (w_id,)),
+			lambda: self.getRow(sID, constants.TABLENAME_DISTRICT, d_key),
+			lambda: self.takeOrderId(sID, w_id, d_id, pending),
+			lambda: self.getRow(sID, constants.TABLENAME_CUSTOMER, (c_id, d_id, w_id), "cold"))
+		w_tax = warehouseInfo.W_TAX
+		d_tax = districtInfo.D_TAX
+		c_discount = customerInfo.C_DISCOUNT
 
 		## -----------------
 		## Insert Order Information
@@ -680,27 +2495,47 @@ class TokyocabinetDriver(AbstractDriver):
 		# INSERT INTO ORDERS (O_ID, O_D_ID, O_W_ID, O_C_ID, O_ENTRY_D, O_CARRIER_ID, O_OL_CNT,
 		#	  O_ALL_LOCAL) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
 
-		key = self.tupleToString((d_next_o_id, d_id, w_id))
+		key = self.recordKey(constants.TABLENAME_ORDERS, (d_next_o_id, d_id, w_id))
 		cols = {"O_ID": d_next_o_id, "O_D_ID": d_id, "O_W_ID": w_id, "O_C_ID":
 						c_id, "O_ENTRY_D": o_entry_d, "O_CARRIER_ID":
-						o_carrier_id, "O_OL_CNT": o_ol_cnt, "O_ALL_LOCAL":
-						all_local}
-		self.conn[sID][constants.TABLENAME_ORDERS].multi_set([(key, cols)])
-
-		# createNewOrder
-		# INSERT INTO NEW_ORDER (NO_O_ID, NO_D_ID, NO_W_ID) VALUES (?, ?, ?)
-
-		key = self.tupleToString((d_next_o_id, d_id, w_id))
-		cols = {"NO_O_ID": d_next_o_id, "NO_D_ID": d_id, "NO_W_ID": w_id}
-		self.conn[sID][constants.TABLENAME_NEW_ORDER].multi_set([(key, cols)])
+						o_carrier_id, "O_OL_CNT": ol_cnt, "O_ALL_LOCAL":
+						int(all_local)}
+		# The customer's last order pointer goes in the same round trip
+		lastOrder = (self.lastOrderKey(w_id, d_id, c_id), {"O_ID": d_next_o_id})
+		self.conn[sID][constants.TABLENAME_ORDERS].multi_set([(key, cols), lastOrder])
 
 		## -------------------------------
 		## Insert Order Item Information
 		## -------------------------------
 
+		# getStockInfo
+		# SELECT S_QUANTITY, S_DATA, S_YTD, S_ORDER_CNT, S_REMOTE_CNT, S_DIST_%02d FROM STOCK
+		#	 WHERE S_I_ID = ? AND S_W_ID = ?
+
+		# updateStock
+		# UPDATE STOCK SET S_QUANTITY = ?, S_YTD = ?, S_ORDER_CNT = ?, S_REMOTE_CNT = ?
+		# 	WHERE S_I_ID = ? AND S_W_ID = ?
+
+		## Lines are grouped by the server of their supply warehouse. Each
+		## server's stock is read and written in one batch, and the batches
+		## of different servers run in parallel
+		serverLines = dict()
+		for i in xrange(len(i_ids)):
+			serverLines.setdefault(self.getServer(i_w_ids[i]), list()).append(i)
+		## FOR
+		serverLines = serverLines.items()
+		stocks = [None] * len(i_ids)
+		results = self.runConcurrently([lambda sSID=sSID, lines=lines: self.updateStocks(sSID, w_id,
+				[(i_ids[i], i_w_ids[i], i_qtys[i]) for i in lines]) for sSID, lines in serverLines])
+		for (sSID, lines), records in zip(serverLines, results):
+			for i, stockInfo in zip(lines, records):
+				stocks[i] = stockInfo
+		## FOR
+
 		item_data = [ ]
+		records = [ ]
 		total = 0
-		for i in xrange(len(i_id)):
+		for i in xrange(len(i_ids)):
 			ol_number = i+1
 			ol_supply_w_id = i_w_ids[i]
 			ol_i_id = i_ids[i]
@@ -709,59 +2544,19 @@ class TokyocabinetDriver(AbstractDriver):
 			# getItemInfo
 			# SELECT I_PRICE, I_NAME, I_DATA FROM ITEM WHERE I_ID = ?
 
-			key, itemInfo = items[i]
-			i_price = float(itemInfo["I_PRICE"])
-			i_name  = itemInfo["I_NAME"]
-			i_data  = itemInfo["I_DATA"]
+			i_price, i_name, i_data = items[i]
 
-			# getStockInfo
-			# SELECT S_QUANTITY, S_DATA, S_YTD, S_ORDER_CNT, S_REMOTE_CNT, S_DIST_%02d FROM STOCK
-			#	 WHERE S_I_ID = ? AND S_W_ID = ?
-
-			stocks = stockQuery.filter(S_I_ID = ol_i_id, S_W_ID = ol_supply_w_id)
-			if len(stocks) == 0:
+			stockInfo = stocks[i]
+			if stockInfo == None:
 				logging.warn("No STOCK record for (ol_i_id=%d, ol_supply_w_id=%d)"
 								% (ol_i_id, ol_supply_w_id))
 				continue
-			stockInfo = stock.columns("S_QUANTITY", "S_DATA", "S_YTD", "S_ORDER_CNT",
-						"S_REMOTE_CNT", "S_DIST_%02d"%d_id)[0]
-
-			s_quantity = int(stockInfo["S_QUANTITY"])
-			s_ytd = float(stockInfo["S_YTD"])
-			s_order_cnt = int(stockInfo["S_ORDER_CNT"])
-			s_remote_cnt = int(stockInfo["S_REMOTE_CNT"])
-			s_data = stockInfo["S_DATA"]
+
+			s_quantity = stockInfo.S_QUANTITY
+			s_data = stockInfo.S_DATA
 			s_dist_xx = stockInfo["S_DIST_%02d"%d_id] 	# Fetches data from the
 									# s_dist_[d_id] column
 
-			# updateStock
-			# UPDATE STOCK SET S_QUANTITY = ?, S_YTD = ?, S_ORDER_CNT = ?, S_REMOTE_CNT = ?
-			# 	WHERE S_I_ID = ? AND S_W_ID = ?
-
-			s_ytd += ol_quantity
-			if s_quantity >= ol_quantity + 10:
-				s_quantity = s_quantity - ol_quantity
-			else:
-				s_quantity = s_quantity + 91 - ol_quantity
-			s_order_cnt += 1
-
-			if ol_supply_w_id != w_id: s_remote_cnt += 1
-
-			sSID = self.getServer(ol_supply_w_id)
-			stockQuery = self.conn[sID][constants.TABLENAME_STOCK].query
-			stocks = stockQuery.filter(S_I_ID = ol_i_id, S_W_ID = ol_supply_w_id)
-			records = list()
-			for record in stocks:
-				key, cols = record
-				cols["S_QUANTITY"] = s_quantity
-				cols["S_YTD"] = s_ytd
-				cols["S_ORDER_CNT"] =  s_order_cnt
-				cols["S_REMOTE_CNT"] = s_remote_cnt
-				records.append((key, cols))
-			## FOR
-
-			self.conn[sSID][constants.TABLENAME_STOCK].multi_set(records)
-
 			if i_data.find(constants.ORIGINAL_STRING) != -1 and s_data.find(constants.ORIGINAL_STRING) != -1:
 				brand_generic = 'B'
 			else:
@@ -775,17 +2570,27 @@ class TokyocabinetDriver(AbstractDriver):
 			# INSERT INTO ORDER_LINE (OL_O_ID, OL_D_ID, OL_W_ID, OL_NUMBER, OL_I_ID, OL_SUPPLY_W_ID,
 			#	OL_DELIVERY_D, OL_QUANTITY, OL_AMOUNT, OL_DIST_INFO) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
 
-			key = tupletoString((d_next_o_id, d_id, w_id, ol_number))
+			key = self.recordKey(constants.TABLENAME_ORDER_LINE, (d_next_o_id, d_id, w_id, ol_number))
 			cols = {"OL_O_ID": d_next_o_id, "OL_D_ID": d_id, "OL_W_ID": w_id,
 					"OL_NUMBER": ol_number, "OL_I_ID": ol_i_id,
 					"OL_SUPPLY_W_ID": ol_supply_w_id, "OL_DELIVERY_D":
-					ol_entry_d, "OL_QUANTITY": ol_quantity, "OL_AMOUNT":
+					o_entry_d, "OL_QUANTITY": ol_quantity, "OL_AMOUNT":
 					ol_amount, "OL_DIST_INFO": s_dist_xx}
-			self.conn[sID][constants.TABLENAME_ORDER_LINE].multi_set([(key, cols)])
+			records.append((key, cols))
 
 			## Add the info to be returned
 			item_data.append((i_name, s_quantity, brand_generic, i_price, ol_amount))
 		## FOR
+		self.conn[sID][constants.TABLENAME_ORDER_LINE].multi_set(records)
+
+		# createNewOrder
+		# INSERT INTO NEW_ORDER (NO_O_ID, NO_D_ID, NO_W_ID) VALUES (?, ?, ?)
+
+		## Written last: once Delivery can pop the order, its lines exist
+		key = self.recordKey(constants.TABLENAME_NEW_ORDER, (d_next_o_id, d_id, w_id))
+		cols = {"NO_O_ID": d_next_o_id, "NO_D_ID": d_id, "NO_W_ID": w_id}
+		self.conn[sID][constants.TABLENAME_NEW_ORDER].multi_set([(key, cols)])
+		del pending[:]
 		
 		## Adjust the total for the discount
 		#print "c_discount:", c_discount, type(c_discount)
@@ -798,6 +2603,8 @@ class TokyocabinetDriver(AbstractDriver):
 
 		return [ customerInfo, misc, item_data ]
 
+	@pooled
+	@readOnly
 	def doOrderStatus(self, params):
 		"""Execute ORDER_STATUS Transaction
 		Parameters Dict:
@@ -806,6 +2613,8 @@ class TokyocabinetDriver(AbstractDriver):
 			c_id
 			c_last
 		"""
+		if self.useProcedures: return self.doOrderStatusProcedures(params)
+
 		w_id = params["w_id"]
 		d_id = params["d_id"]
 		c_id = params["c_id"]
@@ -816,51 +2625,45 @@ class TokyocabinetDriver(AbstractDriver):
 
 		sID = self.getServer(w_id)
 
-		customerQuery = self.conn[sID][constants.TABLENAME_CUSTOMER].query
-		orderQuery    = self.conn[sID][constants.TABLENAME_ORDERS].query
-		orderLineQuery= self.conn[sID][constants.TABLENAME_ORDER_LINE].query
-
 		if c_id != None:
 			# getCustomerByCustomerId
 			# SELECT C_ID, C_FIRST, C_MIDDLE, C_LAST, C_BALANCE FROM CUSTOMER
 			# 	 WHERE C_W_ID = ? AND C_D_ID = ? AND C_ID = ?
 
-			customers = customerQuery.filter(C_W_ID = w_id, C_D_ID = d_id, C_ID = c_id)
-			customerInfo = customers.columns("C_ID", "C_FIRST", "C_MIDDLE", "C_LAST", "C_BALANCE")[0]
+			customerInfo = self.getRow(sID, constants.TABLENAME_CUSTOMER, (c_id, d_id, w_id))
 		else:
 			# Get the midpoint customer's id
 			# getCustomersByLastName
 			# SELECT C_ID, C_FIRST, C_MIDDLE, C_LAST, C_BALANCE FROM CUSTOMER
 			# 	 WHERE C_W_ID = ? AND C_D_ID = ? AND C_LAST = ? ORDER BY C_FIRST
 
-			customers = customerQuery.filter(C_W_ID = w_id, C_D_ID = d_id, C_LAST__contains = c_last).order_by("C_FIRST", numeric=False)
-			all_customers = customers.columns("C_ID", "C_FIRST", "C_MIDDLE", "C_LAST", "C_BALANCE")
-			namecnt = len(all_customers)
-			assert namecnt > 0
-			index = (namecnt-1)/2
-			customerInfo = all_customers[index]
-			c_id = int(customerInfo["C_ID"])
-		assert len(customerInfo) > 0
+			customerInfo = self.getCustomerByLastName(sID, w_id, d_id, c_last)
+			assert customerInfo != None
+			c_id = customerInfo.C_ID
+		assert customerInfo != None
 
-		# getLastOrder TODO: LIMIT 1
+		# getLastOrder
 		# SELECT O_ID, O_CARRIER_ID, O_ENTRY_D FROM ORDERS
 		# 	 WHERE O_W_ID = ? AND O_D_ID = ? AND O_C_ID = ? ORDER BY O_ID DESC LIMIT 1
 
-		orders = orderQuery.filter(O_W_ID = w_id, O_D_ID = d_id, O_C_ID = c_id).order_by("-O_ID", numeric=True)
-		orderInfo = orders.columns("O_ID", "O_CARRIER_ID", "O_ENTRY_D")[0]
+		lastOrder = self.getRecords(sID, constants.TABLENAME_ORDERS, [("O_C_ID", w_id, d_id, c_id)])[0]
+		if lastOrder != None:
+			orderInfo = self.getRow(sID, constants.TABLENAME_ORDERS, (int(lastOrder["O_ID"]), d_id, w_id))
+		else:
+			orderInfo = None
 
 		# getOrderLines
 		# SELECT OL_SUPPLY_W_ID, OL_I_ID, OL_QUANTITY, OL_AMOUNT, OL_DELIVERY_D FROM ORDER_LINE
-		#	 WHERE OL_W_ID = ? AND OL_D_ID = ? AND OL_O_ID = ?        
-		if len(orders) > 0:
-			o_id = int(orderInfo["O_ID"])
-			orders = orderLineQuery.filter(OL_W_ID = w_id, OL_D_ID = d_id, OL_O_ID = o_id)
-			orderLines = orders.columns("OL_SUPPLY_W_ID", "OL_I_ID", "OL_QUANTITY", "OL_AMOUNT", "OL_DELIVERY_D")
+		#	 WHERE OL_W_ID = ? AND OL_D_ID = ? AND OL_O_ID = ?
+		if orderInfo != None:
+			ol_keys = [(orderInfo.O_ID, d_id, w_id, ol_number) for ol_number in xrange(1, orderInfo.O_OL_CNT+1)]
+			orderLines = [ol for ol in self.getRows(sID, constants.TABLENAME_ORDER_LINE, ol_keys) if ol != None]
 		else:
 			orderLines = [ ]
 
 		return [customerInfo, orderInfo, orderLines]
 
+	@pooled
 	def doPayment(self, params):
 		"""Execute PAYMENT Transaction
 		Parameters Dict:
@@ -873,6 +2676,7 @@ class TokyocabinetDriver(AbstractDriver):
 			c_last
 			h_date
 		"""
+		if self.useProcedures: return self.doPaymentProcedures(params)
 
 		w_id = params["w_id"]
 		d_id = params["d_id"]
@@ -886,117 +2690,77 @@ class TokyocabinetDriver(AbstractDriver):
 		sID = self.getServer(w_id)
 		cSID = self.getServer(c_w_id)
 
-		customerQuery  = self.conn[cSID][constants.TABLENAME_CUSTOMER].query
-		warehouseQuery = self.conn[sID][constants.TABLENAME_WAREHOUSE].query
-		districtQuery  = self.conn[sID][constants.TABLENAME_DISTRICT].query
+		## The customer, warehouse and district reads and the YTD updates do
+		## not depend on each other and run concurrently
 
-		if c_id != None:
-			# getCustomerByCustomerId
-			# SELECT C_ID, C_FIRST, C_MIDDLE, C_LAST, C_STREET_1, C_STREET_2, C_CITY, C_STATE,
-			# 	 C_ZIP, C_PHONE, C_SINCE, C_CREDIT, C_CREDIT_LIM, C_DISCOUNT, C_BALANCE,
-			# 	 C_YTD_PAYMENT, C_PAYMENT_CNT, C_DATA FROM CUSTOMER
-			#	WHERE C_W_ID = ? AND C_D_ID = ? AND C_ID = ?
+		def getCustomer():
+			if c_id != None:
+				# getCustomerByCustomerId
+				# SELECT C_ID, C_FIRST, C_MIDDLE, C_LAST, C_STREET_1, C_STREET_2, C_CITY, C_STATE,
+				# 	 C_ZIP, C_PHONE, C_SINCE, C_CREDIT, C_CREDIT_LIM, C_DISCOUNT, C_BALANCE,
+				# 	 C_YTD_PAYMENT, C_PAYMENT_CNT, C_DATA FROM CUSTOMER
+				#	WHERE C_W_ID = ? AND C_D_ID = ? AND C_ID = ?
 
-			customers = customerQuery.filter(C_W_ID = c_w_id, C_D_ID = d_id, C_ID = c_id)
-			customerInfo = customers.columns("C_ID", "C_BALANCE", "C_YTD_PAYMENT", "C_PAYMENT_CNT", "C_DATA")[0]
-		else:
-			# Get the midpoint customer's id
-			# getCustomersByLastName
-			# SELECT C_ID, C_FIRST, C_MIDDLE, C_LAST, C_STREET_1, C_STREET_2, C_CITY, C_STATE,
-			#	 C_ZIP, C_PHONE, C_SINCE, C_CREDIT, C_CREDIT_LIM, C_DISCOUNT, C_BALANCE,
-			#	 C_YTD_PAYMENT, C_PAYMENT_CNT, C_DATA FROM CUSTOMER
-			#	WHERE C_W_ID = ? AND C_D_ID = ? AND C_LAST = ? ORDER BY C_FIRST
-
-			customers = customerQuery.filter(C_W_ID = c_w_id, C_D_ID = d_id, C_LAST__contains = c_last).order_by("C_FIRST", numeric=False)
-			all_customers = customers.columns("C_ID", "C_BALANCE", "C_YTD_PAYMENT", "C_PAYMENT_CNT", "C_DATA")
-			namecnt = len(all_customers)
-			assert namecnt > 0
-			index = (namecnt-1)/2
-			customerInfo = all_customers[index]
-			c_id = int(customerInfo["C_ID"])
-		assert len(customerInfo) > 0
-
-		c_balance = float(customerInfo["C_BALANCE"]) - h_amount
-		c_ytd_payment = float(customerInfo["C_YTD_PAYMENT"]) + h_amount
-		c_payment_cnt = int(customerInfo["C_PAYMENT_CNT"]) + 1
-		c_data = customerInfo["C_DATA"]
+				return self.getRow(cSID, constants.TABLENAME_CUSTOMER, (c_id, c_d_id, c_w_id))
+			else:
+				# Get the midpoint customer's id
+				# getCustomersByLastName
+				# SELECT C_ID, C_FIRST, C_MIDDLE, C_LAST, C_STREET_1, C_STREET_2, C_CITY, C_STATE,
+				#	 C_ZIP, C_PHONE, C_SINCE, C_CREDIT, C_CREDIT_LIM, C_DISCOUNT, C_BALANCE,
+				#	 C_YTD_PAYMENT, C_PAYMENT_CNT, C_DATA FROM CUSTOMER
+				#	WHERE C_W_ID = ? AND C_D_ID = ? AND C_LAST = ? ORDER BY C_FIRST
+
+				return self.getCustomerByLastName(cSID, c_w_id, c_d_id, c_last)
 
 		# getWarehouse
 		# SELECT W_NAME, W_STREET_1, W_STREET_2, W_CITY, W_STATE, W_ZIP FROM WAREHOUSE WHERE W_ID = ?
 
-		warehouses = warehouseQuery.filter(W_ID = w_id)
-		warehouseInfo = warehouses.columns("W_NAME","W_STREET_1", "W_STREET_2", "W_CITY", "W_STATE", "W_ZIP")[0]
-
 		# updateWarehouseBalance
 		# UPDATE WAREHOUSE SET W_YTD = W_YTD + ? WHERE W_ID = ?
 
-		warehouses = warehouseQuery.filter(W_ID = w_id)
-		records = list()
-		for record in warehouses:
-			key, cols = record
-			cols["W_YTD"] = float(cols["W_YTD"]) + h_amount
-			records.append((key, cols))
-		## FOR
-		self.conn[sID][constants.TABLENAME_WAREHOUSE].multi_set(records)
-
 		# getDistrict
 		# SELECT D_NAME, D_STREET_1, D_STREET_2, D_CITY, D_STATE, D_ZIP FROM DISTRICT
 		#	 WHERE D_W_ID = ? AND D_ID = ?
 
-		districts = districtQuery.filter(D_W_ID = w_id, D_ID = d_id)
-		districtInfo = districts.columns("D_NAME", "D_STREET_1", "D_STREET_2", "D_CITY", "D_STATE", "D_ZIP")[0]
-
 		# updateDistrictBalance
 		# UPDATE DISTRICT SET D_YTD = D_YTD + ? WHERE D_W_ID  = ? AND D_ID = ?
 
-		districts = districtQuery.filter(W_ID = w_id, D_ID = d_id)
-		records = list()
-		for record in districts:
-			key, cols = record
-			cols["D_YTD"] = float(cols["D_YTD"]) + h_amount
-			records.append((key, cols))
-		## FOR
-		self.conn[sID][constants.TABLENAME_DISTRICT].multi_set(records)
+		w_key = (w_id,)
+		d_key = (d_id, w_id)
+		customerInfo, warehouseInfo, districtInfo = self.concurrently(getCustomer,
+			lambda: self.getRow(sID, constants.TABLENAME_WAREHOUSE, w_key),
+			lambda: self.getRow(sID, constants.TABLENAME_DISTRICT, d_key),
+			lambda: self.addCounter(sID, constants.TABLENAME_WAREHOUSE, "W_YTD", w_key, h_amount),
+			lambda: self.addCounter(sID, constants.TABLENAME_DISTRICT, "D_YTD", d_key, h_amount))[:3]
+		assert customerInfo != None
+		c_id = customerInfo.C_ID
+
+		c_key = (c_id, c_d_id, c_w_id)
+		c_data = customerInfo.C_DATA
+
+		# updateGCCustomer, and the same columns of updateBCCustomer
+		# UPDATE CUSTOMER SET C_BALANCE = C_BALANCE - ?, C_YTD_PAYMENT = C_YTD_PAYMENT + ?,
+		#	C_PAYMENT_CNT = C_PAYMENT_CNT + 1 WHERE C_W_ID = ? AND C_D_ID = ? AND C_ID = ?
+
+		## The server adds to the customer's columns, so a concurrent
+		## Delivery's changes are kept
+		self.addColumns(cSID, constants.TABLENAME_CUSTOMER, [c_key], ["C_BALANCE", "C_YTD_PAYMENT", "C_PAYMENT_CNT"],
+				[(-h_amount, h_amount, 1)])
 
 		# Customer Credit Information
-		customers = customerQuery.filter(C_W_ID = c_w_id, C_D_ID = c_d_id, C_ID = c_id)
-		cInfo = customers.columns("C_CREDIT")[0]
-		
-		if cInfo["C_CREDIT"] == constants.BAD_CREDIT:
+		if customerInfo.C_CREDIT == constants.BAD_CREDIT:
 			newData = " ".join(map(str, [c_id, c_d_id, c_w_id, d_id, w_id, h_amount]))
 			c_data = (newData + "|" + c_data)
 			if len(c_data) > constants.MAX_C_DATA: c_data =	c_data[:constants.MAX_C_DATA]
 
 			# updateBCCustomer
-			# UPDATE CUSTOMER SET C_BALANCE = ?, C_YTD_PAYMENT = ?, C_PAYMENT_CNT = ?, C_DATA = ?
-			#	WHERE C_W_ID = ? AND C_D_ID = ? AND C_ID = ?
+			# UPDATE CUSTOMER SET C_DATA = ? WHERE C_W_ID = ? AND C_D_ID = ? AND C_ID = ?
 
-			records = list()
-			for record in customers:
-				key, cols = record
-				cols["C_BALANCE"] = c_balance
-				cols["C_YTD_PAYMENT"] = c_ytd_payment
-				cols["C_PAYMENT_CNT"] = c_payment_cnt
-				cols["C_DATA"] = c_data
-				records.append((key, cols))
-			## FOR
-			self.conn[cSID][constants.TABLENAME_CUSTOMER].multi_set(records)
+			self.updateRecord(cSID, constants.TABLENAME_CUSTOMER, c_key, {"C_DATA": c_data})
 		else:
 			c_data = ""
 
-			records = list()
-			# updateGCCustomer
-			# UPDATE CUSTOMER SET C_BALANCE = ?, C_YTD_PAYMENT = ?, C_PAYMENT_CNT = ?
-			#	WHERE C_W_ID = ? AND C_D_ID = ? AND C_ID = ?
-
-			for record in customers:
-				key, cols = record
-				cols["C_BALANCE"] = c_balance
-				cols["C_YTD_PAYMENT"] = c_ytd_payment
-				cols["C_PAYMENT_CNT"] = c_payment_cnt
-				records.append((key, cols))
-			## FOR
-			self.conn[cSID][constants.TABLENAME_CUSTOMER].multi_set(records)
+		## The update also went to customerInfo, the transaction's cached row
 
 		# Concatenate w_name, four space, d_name
 		h_data = "%s    %s" % (warehouseInfo["W_NAME"], districtInfo["D_NAME"])
@@ -1009,7 +2773,7 @@ class TokyocabinetDriver(AbstractDriver):
 		cols = {"H_C_ID": c_id, "H_C_D_ID": c_d_id, "H_C_W_ID": c_w_id, "H_D_ID":
 						d_id, "H_W_ID": w_id, "H_DATE": h_date, "H_AMOUNT":
 						h_amount, "H_DATA": h_data}
-		self.conn[sID][constants.TABLENAME_HISTORY].multi_set([(key, cols)])
+		self.conn[sID][constants.TABLENAME_HISTORY].multi_set([(h_key, cols)])
 
 		# TPC-C 2.5.3.3: Must display the following fields:
 		# W_ID, D_ID, C_ID, C_D_ID, C_W_ID, W_STREET_1, W_STREET_2, W_CITY,
@@ -1022,6 +2786,8 @@ class TokyocabinetDriver(AbstractDriver):
 		# Hand back all the warehouse, district, and customer data
 		return [ warehouseInfo, districtInfo, customerInfo ]
 
+	@pooled
+	@readOnly
 	def doStockLevel(self, params):
 		"""Execute STOCK_LEVEL Transaction
 		Parameters Dict:
@@ -1029,33 +2795,356 @@ class TokyocabinetDriver(AbstractDriver):
 			d_id
 			threshold
 		"""
+		if self.useProcedures: return self.doStockLevelProcedures(params)
+
 		w_id = params["w_id"]
 		d_id = params["d_id"]
 		threshold = params["threshold"]
 
 		sID = self.getServer(w_id)
 
-		districtQuery  = self.conn[sID][constants.TABLENAME_DISTRICT].query
-		orderLineQuery = self.conn[sID][constants.TABLENAME_ORDER_LINE].query
-		stockQuery     = self.conn[sID][constants.TABLENAME_STOCK].query
-
 		# getOId
 		# "SELECT D_NEXT_O_ID FROM DISTRICT WHERE D_W_ID = ? AND D_ID = ?"
 
-		districts = districtQuery.filter(D_W_ID = w_id, D_ID = d_id)
-		o_id = int(districts.columns("D_NEXT_O_ID")[0]["D_NEXT_O_ID"])
+		o_id = self.readCounter(sID, constants.TABLENAME_DISTRICT, "D_NEXT_O_ID", (d_id, w_id))
 
 		# getStockCount
 		# SELECT COUNT(DISTINCT(OL_I_ID)) FROM ORDER_LINE, STOCK WHERE OL_W_ID = ? AND OL_D_ID = ?
 		# 	AND OL_O_ID < ? AND OL_O_ID >= ? AND S_W_ID = ? AND S_I_ID = OL_I_ID AND S_QUANTITY < ?
       
-		orders = orderLineQuery.filter(OL_W_ID = w_id, OL_D_ID = d_id, OL_O_ID__between = [(o_id-20), (o_id-1)]) 
-		ol_i_ids = set([i["OL_I_ID"] for i in orders.columns("OL_I_ID")])
+		## Orders have at most MAX_OL_CNT lines: probe all their keys, the
+		## server skips the ones that do not exist. With ordered tables the
+		## lines of the last 20 orders are a key range instead. Each server
+		## holds a single table, so the distinct item ids make one trip
+		## through the client on their way to STOCK
+		codec = self.keyCodecs.get(constants.TABLENAME_ORDER_LINE)
+		if codec != None:
+			ol_i_ids = self.aggregateRange(sID, constants.TABLENAME_ORDER_LINE, "distinctcols",
+					codec.prefix(w_id, d_id, o_id-20), codec.prefix(w_id, d_id, o_id), "OL_I_ID")
+		else:
+			ol_keys = [(ol_o_id, d_id, w_id, ol_number) for ol_o_id in xrange(o_id-20, o_id)
+					for ol_number in xrange(1, constants.MAX_OL_CNT+1)]
+			ol_i_ids = self.aggregate(sID, constants.TABLENAME_ORDER_LINE, "distinctcols", ol_keys, "OL_I_ID")
+
+		s_keys = [(ol_i_id, w_id) for ol_i_id in ol_i_ids]
+		cnt = self.aggregate(sID, constants.TABLENAME_STOCK, "countcols", s_keys, "S_QUANTITY", ["lt", threshold])
+
+		return int(cnt[0]) if cnt else 0
+
+	## ----------------------------------------------
+	## Warehouse migration
+	## ----------------------------------------------
+
+	## tokyocabinetmigrate.py moves warehouses between servers while the
+	## benchmark runs, one warehouse at a time. Clients find out through
+	## the partition map (see refreshPartitionMap)
+
+	def warehouseKeys(self, sID, tableName, w_id):
+		"""Returns the keys of all records of a warehouse in one server's
+		   table: its rows, found through the partition column, and the
+		   counters, queue heads, name lists and last order pointers kept
+		   next to them. The rows of ordered tables share their key prefix"""
+		proto = self.conn[sID][tableName].proto
+		if tableName in self.keyCodecs:
+			keys = list(proto.fwmkeys(self.keyCodecs[tableName].prefix(w_id)))
+		else:
+			conds = [(TABLE_PARTITION_COLUMNS[tableName], protocol.TyrantProtocol.RDBQCNUMEQ, str(w_id))]
+			keys = list(proto.search(conds, limit=None))
+
+		counters = TABLE_COUNTERS.get(tableName, [ ])
+		if tableName == constants.TABLENAME_NEW_ORDER and not tableName in self.keyCodecs:
+			counters = [ "NO_O_ID" ]
+		if tableName == constants.TABLENAME_WAREHOUSE:
+			rowKeys = [(w_id,)]
+		else:
+			rowKeys = [(d_id, w_id) for d_id in xrange(1, constants.DISTRICTS_PER_WAREHOUSE+1)]
+		keys.extend(self.counterKey(column, key) for column in counters for key in rowKeys)
+
+		if tableName == constants.TABLENAME_CUSTOMER:
+			keys.extend(proto.fwmkeys(self.tupleToString(("C_LAST", w_id, ""))))
+		elif tableName == constants.TABLENAME_ORDERS:
+			keys.extend(proto.fwmkeys(self.tupleToString(("O_C_ID", w_id, ""))))
+		return keys
+
+	def setPartition(self, w_id, sID):
+		"""Records the server of a warehouse in the partition map of every
+		   server"""
+		record = (self.tupleToString(("PARTITION", w_id)), {"SERVER": sID})
+		for tables in self.conn.itervalues():
+			tables[constants.TABLENAME_ITEM].multi_set([record])
+		## FOR
+
+	def migrateWarehouse(self, w_id, dst):
+		"""Moves all records of a warehouse to server dst. The warehouse is
+		   first marked as moving, and the copy only starts once every client
+		   had time to notice: their transactions on the warehouse wait
+		   until it is done. The records are then copied, the new location
+		   is published and the old copies are deleted"""
+		src = self.getServer(w_id)
+		if src == dst: return
+		logging.info("Moving warehouse %d from server '%s' to server '%s'" % (w_id, src, dst))
+
+		self.setPartition(w_id, PARTITION_MOVING)
+		time.sleep(self.partitionRefresh + 1)
+
+		moved = dict()
+		for tableName, column in TABLE_PARTITION_COLUMNS.iteritems():
+			if column == None: continue
+			keys = self.warehouseKeys(src, tableName, w_id)
+			for i in xrange(0, len(keys), self.batchSize):
+				found = self.conn[src][tableName].proto.mget(keys[i:i+self.batchSize])
+				self.conn[dst][tableName].multi_set([(key, self.stringToRecord(value)) for key, value in found])
+			## FOR
+			moved[tableName] = keys
+			logging.debug("Copied %d %s records of warehouse %d" % (len(keys), tableName, w_id))
+		## FOR
+
+		self.setPartition(w_id, dst)
+		self.partitionMap[w_id] = dst
+
+		for tableName, keys in moved.iteritems():
+			for i in xrange(0, len(keys), self.batchSize):
+				self.conn[src][tableName].multi_del(keys[i:i+self.batchSize])
+		## FOR
+		self.releaseConnections()
+
+	## ----------------------------------------------
+	## Transaction procedures
+	## ----------------------------------------------
+
+	## With procedures enabled each transaction runs as one Lua call per
+	## table it touches (see tokyocabinetdriver.lua), instead of one round
+	## trip per statement. The results are the same as the ones returned by
+	## the client-side implementations above.
+
+	def doDeliveryProcedures(self, params):
+		w_id = params["w_id"]
+		o_carrier_id = params["o_carrier_id"]
+		ol_delivery_d = params["ol_delivery_d"]
+
+		sID = self.getServer(w_id)
+
+		# getNewOrder, deleteNewOrder
+		if constants.TABLENAME_NEW_ORDER in self.keyCodecs:
+			d_ids = range(1, constants.DISTRICTS_PER_WAREHOUSE+1)
+			newOrders = [(d_id, no_o_id) for d_id, no_o_id in zip(d_ids, self.popNewOrders(sID, w_id, d_ids)) if no_o_id != None]
+		else:
+			result = self.stringToList(self.callProcedure(sID, constants.TABLENAME_NEW_ORDER, "delivery_neworders",
+						[str(w_id)], [constants.DISTRICTS_PER_WAREHOUSE], locking=True))
+			newOrders = [(int(result[i]), int(result[i+1])) for i in xrange(0, len(result), 2)]
+		if len(newOrders) == 0:
+			return [ ]
+
+		# getCId, updateOrders
+		o_keys = [self.recordKey(constants.TABLENAME_ORDERS, (no_o_id, d_id, w_id)) for d_id, no_o_id in newOrders]
+		result = self.stringToList(self.callProcedure(sID, constants.TABLENAME_ORDERS, "delivery_orders",
+					o_keys, [o_carrier_id], locking=True))
+		orders = [(int(result[i]), int(result[i+1])) for i in xrange(0, len(result), 2)]
+
+		# sumOLAmount, updateOrderLine
+		ol_keys = list()
+		for (d_id, no_o_id), (c_id, ol_cnt) in zip(newOrders, orders):
+			ol_keys.extend(self.recordKey(constants.TABLENAME_ORDER_LINE, (no_o_id, d_id, w_id, ol_number)) for ol_number in xrange(1, ol_cnt+1))
+		## FOR
+		result = self.stringToList(self.callProcedure(sID, constants.TABLENAME_ORDER_LINE, "delivery_orderlines",
+					ol_keys, [ol_delivery_d] + [ol_cnt for c_id, ol_cnt in orders], locking=True))
+		ol_totals = [float(t) for t in result]
+
+		# updateCustomer
+		c_keys = [self.tupleToString((c_id, d_id, w_id)) for (d_id, no_o_id), (c_id, ol_cnt) in zip(newOrders, orders)]
+		self.callProcedure(sID, constants.TABLENAME_CUSTOMER, "delivery_customers", c_keys, ol_totals, locking=True)
+
+		return newOrders
+
+	def doNewOrderProcedures(self, params):
+		w_id = params["w_id"]
+		d_id = params["d_id"]
+		c_id = params["c_id"]
+		o_entry_d = params["o_entry_d"]
+		i_ids = params["i_ids"]
+		i_w_ids = params["i_w_ids"]
+		i_qtys = params["i_qtys"]
+
+		sID = self.getServer(w_id)
+		all_local = all(i_w_id == w_id for i_w_id in i_w_ids)
+
+		# getItemInfo
+		items = self.getItems(sID, i_ids)
+		if None in items:
+			## TODO Abort here!
+			return
+
+		# getWarehouseTaxRate
+		w_tax = self.getRow(sID, constants.TABLENAME_WAREHOUSE, (w_id,)).W_TAX
+
+		# getDistrict, incrementNextOrderId
+		d_key = (d_id, w_id)
+		d_tax, d_next_o_id = self.stringToList(self.callProcedure(sID, constants.TABLENAME_DISTRICT, "neworder_district",
+					[self.tupleToString(d_key)], [self.counterKey("D_NEXT_O_ID", d_key)]))
+		d_tax = float(d_tax)
+		d_next_o_id = int(d_next_o_id)
+		self.pendingOrders.orders.append((w_id, d_id, d_next_o_id))
+
+		# getCustomer
+		customerInfo = self.getRow(sID, constants.TABLENAME_CUSTOMER, (c_id, d_id, w_id), "cold")
+		c_discount = customerInfo.C_DISCOUNT
+
+		# getStockInfo, updateStock: one call per supply server, in parallel
+		serverLines = dict()
+		for i in xrange(len(i_ids)):
+			serverLines.setdefault(self.getServer(i_w_ids[i]), list()).append(i)
+		## FOR
+		serverLines = serverLines.items()
+		calls = [ ]
+		for sSID, lines in serverLines:
+			s_keys = [self.tupleToString((i_ids[i], i_w_ids[i])) for i in lines]
+			args = ["S_DIST_%02d" % d_id, w_id]
+			for i in lines:
+				args.extend((i_w_ids[i], i_qtys[i]))
+			## FOR
+			calls.append(lambda sSID=sSID, s_keys=s_keys, args=args: self.stringToList(self.callProcedure(sSID,
+					constants.TABLENAME_STOCK, "neworder_stock", s_keys, args, locking=True)))
+		## FOR
+		stocks = [None] * len(i_ids)
+		for (sSID, lines), result in zip(serverLines, self.runConcurrently(calls)):
+			for j, i in enumerate(lines):
+				stocks[i] = result[3*j:3*j+3]
+			## FOR
+		## FOR
 
-		stocks = stockQuery.filter(S_W_ID = w_id, S_I_ID__in = list(ol_i_ids), S_QUANTITY__lt = threshold).columns("S_W_ID")
+		# createOrder
+		o_key = self.recordKey(constants.TABLENAME_ORDERS, (d_next_o_id, d_id, w_id))
+		self.conn[sID][constants.TABLENAME_ORDERS].multi_set([(o_key, {"O_ID": d_next_o_id, "O_D_ID": d_id,
+					"O_W_ID": w_id, "O_C_ID": c_id, "O_ENTRY_D": o_entry_d, "O_CARRIER_ID": constants.NULL_CARRIER_ID,
+					"O_OL_CNT": len(i_ids), "O_ALL_LOCAL": int(all_local)}),
+					(self.lastOrderKey(w_id, d_id, c_id), {"O_ID": d_next_o_id})])
+
+		# createOrderLine
+		item_data = [ ]
+		records = [ ]
+		total = 0
+		for i in xrange(len(i_ids)):
+			i_price, i_name, i_data = items[i]
+			s_quantity, s_data, s_dist_xx = stocks[i]
+			if s_quantity == "":
+				logging.warn("No STOCK record for (ol_i_id=%d, ol_supply_w_id=%d)" % (i_ids[i], i_w_ids[i]))
+				continue
+			s_quantity = int(s_quantity)
+
+			if i_data.find(constants.ORIGINAL_STRING) != -1 and s_data.find(constants.ORIGINAL_STRING) != -1:
+				brand_generic = 'B'
+			else:
+				brand_generic = 'G'
+
+			ol_amount = i_qtys[i] * i_price
+			total += ol_amount
+
+			records.append((self.recordKey(constants.TABLENAME_ORDER_LINE, (d_next_o_id, d_id, w_id, i+1)), {"OL_O_ID": d_next_o_id,
+					"OL_D_ID": d_id, "OL_W_ID": w_id, "OL_NUMBER": i+1, "OL_I_ID": i_ids[i],
+					"OL_SUPPLY_W_ID": i_w_ids[i], "OL_DELIVERY_D": o_entry_d, "OL_QUANTITY": i_qtys[i],
+					"OL_AMOUNT": ol_amount, "OL_DIST_INFO": s_dist_xx}))
+			item_data.append((i_name, s_quantity, brand_generic, i_price, ol_amount))
+		## FOR
+		self.conn[sID][constants.TABLENAME_ORDER_LINE].multi_set(records)
+
+		# createNewOrder, last so that Delivery never pops an order without lines
+		no_key = self.recordKey(constants.TABLENAME_NEW_ORDER, (d_next_o_id, d_id, w_id))
+		self.conn[sID][constants.TABLENAME_NEW_ORDER].multi_set([(no_key, {"NO_O_ID": d_next_o_id,
+					"NO_D_ID": d_id, "NO_W_ID": w_id})])
+		del self.pendingOrders.orders[:]
+
+		total *= (1 - c_discount) * (1 + w_tax + d_tax)
+		misc = [(w_tax, d_tax, d_next_o_id, total)]
+
+		return [ customerInfo, misc, item_data ]
+
+	def doOrderStatusProcedures(self, params):
+		w_id = params["w_id"]
+		d_id = params["d_id"]
+		c_id = params["c_id"]
+		c_last = params["c_last"]
+
+		sID = self.getServer(w_id)
+
+		# getCustomerByCustomerId, getCustomersByLastName
+		c_key = self.tupleToString((c_id, d_id, w_id)) if c_id != None else ""
+		customerInfo = self.recordCodecs[constants.TABLENAME_CUSTOMER].decode(self.callProcedure(sID, constants.TABLENAME_CUSTOMER, "orderstatus_customer",
+					[c_key], [w_id, d_id, c_last or ""]))
+		c_id = customerInfo.C_ID
+
+		# getLastOrder
+		ordered = int(constants.TABLENAME_ORDERS in self.keyCodecs)
+		order = self.callProcedure(sID, constants.TABLENAME_ORDERS, "orderstatus_order", [ ], [w_id, d_id, c_id, ordered])
+		if order == "":
+			return [customerInfo, None, [ ]]
+		orderInfo = self.recordCodecs[constants.TABLENAME_ORDERS].decode(order)
+
+		# getOrderLines
+		ol_keys = [(orderInfo.O_ID, d_id, w_id, ol_number) for ol_number in xrange(1, orderInfo.O_OL_CNT+1)]
+		orderLines = [ol for ol in self.getRows(sID, constants.TABLENAME_ORDER_LINE, ol_keys) if ol != None]
+
+		return [customerInfo, orderInfo, orderLines]
+
+	def doPaymentProcedures(self, params):
+		w_id = params["w_id"]
+		d_id = params["d_id"]
+		h_amount = params["h_amount"]
+		c_w_id = params["c_w_id"]
+		c_d_id = params["c_d_id"]
+		c_id = params["c_id"]
+		c_last = params["c_last"]
+		h_date = params["h_date"]
+
+		sID = self.getServer(w_id)
+		cSID = self.getServer(c_w_id)
+
+		# getWarehouse, updateWarehouseBalance
+		w_key = (w_id,)
+		warehouseInfo = self.recordCodecs[constants.TABLENAME_WAREHOUSE].decode(self.callProcedure(sID, constants.TABLENAME_WAREHOUSE, "payment_ytd",
+					[self.tupleToString(w_key)], [self.counterKey("W_YTD", w_key), h_amount]))
 
-		cnt = len(stocks)
+		# getDistrict, updateDistrictBalance
+		d_key = (d_id, w_id)
+		districtInfo = self.recordCodecs[constants.TABLENAME_DISTRICT].decode(self.callProcedure(sID, constants.TABLENAME_DISTRICT, "payment_ytd",
+					[self.tupleToString(d_key)], [self.counterKey("D_YTD", d_key), h_amount]))
 
-		return cnt
+		# getCustomerByCustomerId, getCustomersByLastName, updateBCCustomer, updateGCCustomer
+		c_key = self.tupleToString((c_id, c_d_id, c_w_id)) if c_id != None else ""
+		customerInfo = self.recordCodecs[constants.TABLENAME_CUSTOMER].decode(self.callProcedure(cSID, constants.TABLENAME_CUSTOMER, "payment_customer",
+					[c_key], [c_w_id, c_d_id, c_last or "", h_amount, w_id, d_id, constants.BAD_CREDIT,
+					constants.MAX_C_DATA], locking=True))
+		c_id = customerInfo.C_ID
+
+		# insertHistory
+		h_data = "%s    %s" % (warehouseInfo["W_NAME"], districtInfo["D_NAME"])
+		h_key = self.tupleToString((c_id, c_d_id, c_w_id))
+		self.conn[sID][constants.TABLENAME_HISTORY].multi_set([(h_key, {"H_C_ID": c_id, "H_C_D_ID": c_d_id,
+					"H_C_W_ID": c_w_id, "H_D_ID": d_id, "H_W_ID": w_id, "H_DATE": h_date, "H_AMOUNT": h_amount,
+					"H_DATA": h_data})])
+
+		return [ warehouseInfo, districtInfo, customerInfo ]
+
+	def doStockLevelProcedures(self, params):
+		w_id = params["w_id"]
+		d_id = params["d_id"]
+		threshold = params["threshold"]
+
+		sID = self.getServer(w_id)
+
+		# getOId
+		o_id = self.readCounter(sID, constants.TABLENAME_DISTRICT, "D_NEXT_O_ID", (d_id, w_id))
+
+		# getStockCount
+		codec = self.keyCodecs.get(constants.TABLENAME_ORDER_LINE)
+		if codec != None:
+			ol_i_ids = self.aggregateRange(sID, constants.TABLENAME_ORDER_LINE, "distinctcols",
+					codec.prefix(w_id, d_id, o_id-20), codec.prefix(w_id, d_id, o_id), "OL_I_ID")
+		else:
+			ol_i_ids = self.stringToList(self.callProcedure(sID, constants.TABLENAME_ORDER_LINE, "stocklevel_items",
+						[ ], [w_id, d_id, o_id-20, o_id-1, constants.MAX_OL_CNT]))
+		if len(ol_i_ids) == 0:
+			return 0
+		s_keys = [self.tupleToString((i_id, w_id)) for i_id in ol_i_ids]
+		return int(self.callProcedure(sID, constants.TABLENAME_STOCK, "stocklevel_count", s_keys, [threshold]))
 
 ## CLASS
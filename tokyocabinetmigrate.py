@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------
+# Copyright (C) 2011
+# Marcelo Martins
+# http://www.cs.brown.edu/~martins/
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------
+
+## Moves warehouses between the servers of the Tokyo Cabinet driver while
+## the benchmark is running. CONFIG is the configuration the clients run
+## with, TARGET the same servers with the new partitioner settings (for
+## instance a new server's weight raised from 0). Only the warehouses
+## whose server changes are moved. Run it from the py-tpcc directory:
+##
+##   PYTHONPATH=. python drivers/tokyocabinetmigrate.py \
+##       --config=CONFIG --target=TARGET --warehouses=N
+
+from ConfigParser import SafeConfigParser
+from optparse import OptionParser
+from tokyocabinetdriver import TokyocabinetDriver, makePartitioner
+
+import logging
+import sys
+
+## ==============================================
+## readConfig
+## ==============================================
+def readConfig(path):
+	"""Reads the tokyocabinet section of a py-tpcc configuration file,
+	   using the driver defaults for missing parameters"""
+	parser = SafeConfigParser()
+	assert parser.read(path), "Cannot read configuration file '%s'" % path
+	config = dict((key, value[1]) for key, value in TokyocabinetDriver.DEFAULT_CONFIG.iteritems())
+	config.update(parser.items("tokyocabinet"))
+	config["reset"] = False
+	return config
+
+## ==============================================
+## main
+## ==============================================
+def main(argv):
+	parser = OptionParser(usage="%prog --config=CONFIG --target=TARGET --warehouses=N [--dry-run]")
+	parser.add_option("--config", help="Configuration the running clients use")
+	parser.add_option("--target", help="Configuration with the new partitioner settings")
+	parser.add_option("--warehouses", type="int", help="Number of warehouses of the database")
+	parser.add_option("--dry-run", action="store_true", default=False, help="Only print the moves")
+	parser.add_option("--debug", action="store_true", default=False, help="Enable debug log messages")
+	options, args = parser.parse_args(argv)
+	if not options.config or not options.target or not options.warehouses:
+		parser.error("--config, --target and --warehouses are required")
+	logging.basicConfig(level = logging.DEBUG if options.debug else logging.INFO,
+						format="%(asctime)s [%(funcName)s:%(lineno)03d] %(levelname)-5s: %(message)s")
+
+	driver = TokyocabinetDriver(None)
+	driver.loadConfig(readConfig(options.config))
+
+	target = readConfig(options.target)
+	assert sorted(eval(target["servers"]).keys()) == sorted(driver.databases.keys()), \
+		"The target configuration must have the same servers"
+	partitioner = makePartitioner(target, driver.databases.keys())
+
+	moves = [ ]
+	for w_id in xrange(1, options.warehouses+1):
+		src = driver.getServer(w_id)
+		dst = partitioner.getServer(w_id)
+		if src != dst:
+			moves.append((w_id, src, dst))
+	## FOR
+	logging.info("Moving %d of %d warehouses" % (len(moves), options.warehouses))
+
+	for w_id, src, dst in moves:
+		if options.dry_run:
+			print "Warehouse %d: server '%s' -> server '%s'" % (w_id, src, dst)
+			continue
+		driver.migrateWarehouse(w_id, dst)
+	## FOR
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------
+# Copyright (C) 2011
+# Marcelo Martins
+# http://www.cs.brown.edu/~martins/
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# -----------------------------------------------------------------------
+
+## Plans the Tokyo Cabinet tuning of the driver's ttservers. From the number
+## of warehouses and the servers of a configuration (or a number of servers
+## with the default layout) it estimates the records and bytes of every
+## server's table, and prints ttserver command lines with bucket counts,
+## mapped memory and caches sized for them. With --check it compares the
+## estimates with the stats of the running servers instead. Run it from
+## the py-tpcc directory:
+##
+##   PYTHONPATH=. python drivers/tokyocabinetplanner.py \
+##       --config=CONFIG --warehouses=N [--memory=MB] [--check]
+
+from ConfigParser import SafeConfigParser
+from optparse import OptionParser
+from tokyocabinetdriver import TokyocabinetDriver, ColumnCompressor, makePartitioner, sampleColumns, trainDictionary
+from tokyocabinetdriver import DICTIONARY_SAMPLES
+from tokyocabinetdriver import COLUMN_TYPES, HOT_COLUMNS, ORDERED_KEYS, TABLE_COLUMNS, TABLE_COUNTERS, TABLE_KEYS
+from tokyocabinetmigrate import readConfig
+
+import constants
+import logging
+import math
+import pyrant
+import random
+import string
+import sys
+
+## Average lengths of the values the TPC-C loader generates, for the
+## VARCHAR columns (clause 4.3.3.1) and the other column types. Numbers
+## are stored as their decimal strings, timestamps as str(datetime)
+VARCHAR_WIDTHS = {
+	"W_NAME": 8, "D_NAME": 8, "I_NAME": 19, "C_FIRST": 12, "C_MIDDLE": 2, "C_LAST": 12,
+	"W_STREET_1": 15, "W_STREET_2": 15, "W_CITY": 15, "W_STATE": 2, "W_ZIP": 9,
+	"D_STREET_1": 15, "D_STREET_2": 15, "D_CITY": 15, "D_STATE": 2, "D_ZIP": 9,
+	"C_STREET_1": 15, "C_STREET_2": 15, "C_CITY": 15, "C_STATE": 2, "C_ZIP": 9,
+	"C_PHONE": 16, "C_CREDIT": 2, "C_DATA": 400, "H_DATA": 18, "I_DATA": 38, "S_DATA": 38,
+	"OL_DIST_INFO": 24,
+}
+for i in xrange(1, 11):
+	VARCHAR_WIDTHS["S_DIST_%02d" % i] = 24
+TYPE_WIDTHS = {
+	"TINYINT": 2,
+	"SMALLINT": 4,
+	"INT": 4,
+	"INTEGER": 4,
+	"FLOAT": 6,
+	"TIMESTAMP": 26,
+}
+
+## Bytes Tokyo Cabinet adds to each record of a hash database (header and
+## padding to 2^apow), and to each record of a B+tree leaf
+HASH_RECORD_OVERHEAD = 16
+TREE_RECORD_OVERHEAD = 4
+## Members of a B+tree leaf and non-leaf page (the lmemb and nmemb defaults)
+LEAF_MEMBERS = 128
+NODE_MEMBERS = 256
+## Bucket arrays get this many buckets per record (Tokyo Cabinet advises
+## 0.5 to 4), and databases larger than 2GB need the "l" option
+BUCKETS_PER_RECORD = 2
+LARGE_SIZE = 2 << 30
+## Tables read by nearly every transaction, whose records all go to the
+## record cache
+CACHED_TABLES = [
+	constants.TABLENAME_ITEM,
+	constants.TABLENAME_WAREHOUSE,
+	constants.TABLENAME_DISTRICT,
+]
+## Stats of a running server may differ from the estimates by this factor
+TOLERANCE = 1.5
+## Bucket counts of databases opened without tuning parameters
+DEFAULT_BUCKETS = { False: 131071, True: 32749 }
+## A hash database with more records per bucket has long chains
+MAX_RECORDS_PER_BUCKET = 4
+
+## ==============================================
+## TableModel
+## ==============================================
+class TableModel(object):
+	"""Estimated contents of one server's table: the number of records,
+	   their total size and the resulting database file size"""
+
+	def __init__(self, tableName, ordered):
+		self.tableName = tableName
+		self.ordered = ordered
+		self.records = 0
+		self.bytes = 0
+
+	def add(self, count, size):
+		"""Adds count records of the given key plus value size"""
+		overhead = TREE_RECORD_OVERHEAD if self.ordered else HASH_RECORD_OVERHEAD
+		self.records += int(count)
+		self.bytes += int(count * (size + overhead))
+
+	def buckets(self):
+		if self.ordered:
+			return max(1, self.leaves() * BUCKETS_PER_RECORD)
+		return max(1, self.records * BUCKETS_PER_RECORD)
+
+	def leaves(self):
+		return int(math.ceil(float(self.records) / LEAF_MEMBERS))
+
+	def large(self):
+		return self.bytes > LARGE_SIZE
+
+	def fileSize(self):
+		"""Header, bucket array (8 byte buckets with the "l" option) and
+		   records"""
+		return 256 + self.buckets() * (8 if self.large() else 4) + self.bytes
+
+	def tuning(self, xmsiz):
+		"""Returns the tuning parameters of the database name, as a list of
+		   (name, value) pairs"""
+		params = [ ("bnum", self.buckets()) ]
+		if self.ordered:
+			params += [ ("lmemb", LEAF_MEMBERS), ("nmemb", NODE_MEMBERS) ]
+		elif self.tableName in CACHED_TABLES:
+			params.append(("rcnum", self.records))
+		## Leaf caches of the B+tree, or of the column indexes of a table
+		## database, large enough for one entry per record
+		lcnum = max(64, self.leaves())
+		params += [ ("lcnum", lcnum), ("ncnum", max(64, lcnum / NODE_MEMBERS)), ("xmsiz", xmsiz) ]
+		if self.large():
+			params.append(("opts", "l"))
+		return params
+
+	def path(self, sID, xmsiz):
+		"""Database name with its tuning parameters. Each server's files
+		   are kept in their own directory, as with the embedded engine"""
+		suffix = "tcb" if self.ordered else "tct"
+		return "%s/%s.%s#%s" % (sID, self.tableName.lower(), suffix, "#".join("%s=%s" % p for p in self.tuning(xmsiz)))
+
+## ==============================================
+## RowModel
+## ==============================================
+class RowModel(object):
+	"""Sizes of the records the driver stores, following its own layout:
+	   the key from recordKey or KeyCodec, "name\0value\0" for every column,
+	   counters in their own records, split and compressed columns as
+	   configured"""
+
+	def __init__(self, warehouses, splitTables, compressedColumns, orderedTables):
+		self.warehouses = warehouses
+		self.splitTables = splitTables
+		self.orderedTables = orderedTables
+		self.widths = dict()
+		for name, columnType in COLUMN_TYPES.iteritems():
+			if columnType == "VARCHAR":
+				self.widths[name] = VARCHAR_WIDTHS.get(name, 10)
+			elif columnType == "SMALLINT":
+				self.widths[name] = len(str(warehouses))
+			else:
+				self.widths[name] = TYPE_WIDTHS[columnType]
+		## FOR
+		if len(compressedColumns) > 0:
+			compressor = ColumnCompressor(trainDictionary(sampleColumns(DICTIONARY_SAMPLES)))
+			for name in compressedColumns:
+				sample = "".join(random.choice(string.ascii_lowercase) for i in xrange(self.widths[name]))
+				self.widths[name] = len(compressor.compress(sample))
+		## IF
+
+	def keySize(self, tableName, columns=None):
+		if tableName in self.orderedTables:
+			return sum(width for c, width in ORDERED_KEYS[tableName])
+		columns = columns or TABLE_KEYS[tableName]
+		return sum(self.widths.get(c, 4) for c in columns) + len(columns) - 1
+
+	def valueSize(self, columns):
+		return sum(len(c) + self.widths[c] + 2 for c in columns)
+
+	def lookups(self, tableName):
+		"""Returns (records per warehouse, key plus value size) pairs for
+		   the lookup records the driver adds: the C_LAST lists (about a
+		   thousand last names per district, with about three C_IDs each),
+		   the last O_ID of every customer and, unless NEW_ORDER is
+		   ordered, the queue head counter of every district"""
+		w, d, c = self.widths["C_W_ID"], self.widths["C_D_ID"], self.widths["C_ID"]
+		districts = constants.DISTRICTS_PER_WAREHOUSE
+		if tableName == constants.TABLENAME_CUSTOMER:
+			return [(districts * 1000, len("C_LAST") + 3 + w + d + self.widths["C_LAST"] + len("C_IDS") + 3 * (c + 1) + 1)]
+		if tableName == constants.TABLENAME_ORDERS:
+			return [(districts * constants.CUSTOMERS_PER_DISTRICT, len("O_C_ID") + 3 + w + d + c + self.valueSize(["O_ID"]))]
+		if tableName == constants.TABLENAME_NEW_ORDER and not tableName in self.orderedTables:
+			key = self.keySize(constants.TABLENAME_DISTRICT)
+			return [(districts, len("NO_O_ID") + 1 + key + len("_num") + self.widths["NO_O_ID"] + 2)]
+		return [ ]
+
+	def rowSizes(self, tableName):
+		"""Returns the key plus value sizes of the records of one row"""
+		counters = TABLE_COUNTERS.get(tableName, [ ])
+		columns = [c for c in TABLE_COLUMNS[tableName] if not c in counters]
+		key = self.keySize(tableName)
+		sizes = [len(c) + 1 + key + len("_num") + self.widths[c] + 2 for c in counters]
+		if tableName in self.splitTables:
+			hot, cold = self.splitTables[tableName]
+			sizes.append(key + self.valueSize([c for c in columns if c in hot]))
+			sizes.append(len("COLD:") + key + self.valueSize([c for c in columns if c in cold]))
+		else:
+			sizes.append(key + self.valueSize(columns))
+		return sizes
+
+## ==============================================
+## plan
+## ==============================================
+def plan(config, warehouses, transactions):
+	"""Returns { sID: { tableName: TableModel } } for the servers of a
+	   driver configuration, after the given number of transactions"""
+	servers = eval(str(config["servers"]))
+	partitioner = makePartitioner(config, servers.keys())
+	counts = dict((sID, 0) for sID in servers.keys())
+	for w_id in xrange(1, warehouses+1):
+		counts[partitioner.getServer(w_id)] += 1
+
+	isSet = lambda name: str(config[name]).lower() in ("true", "yes", "1")
+	splitTables = dict()
+	if isSet("split_tables"):
+		for tableName, columns in HOT_COLUMNS.iteritems():
+			cold = [c for c in TABLE_COLUMNS[tableName] if not c in columns or c in TABLE_KEYS[tableName]]
+			splitTables[tableName] = (frozenset(columns), frozenset(cold))
+	orderedTables = ORDERED_KEYS.keys() if isSet("ordered_tables") else [ ]
+	compressedColumns = [c.strip() for c in str(config["compress_columns"]).split(",") if c.strip()]
+	model = RowModel(warehouses, splitTables, compressedColumns, orderedTables)
+
+	## Rows per warehouse after loading, and added by each transaction.
+	## NewOrder is 45% of the mix and adds an order; Delivery is 4% and
+	## removes a new order per district. HISTORY rows are keyed by customer
+	## (see TABLE_KEYS), so a Payment overwrites the row of its customer,
+	## loaded on the customer's server. Only the 15% of Payments to a
+	## remote customer, 43% of the mix, add rows to the paying warehouse's
+	## server, at most one per customer of the other warehouses
+	districts = constants.DISTRICTS_PER_WAREHOUSE
+	customers = districts * constants.CUSTOMERS_PER_DISTRICT
+	orders = districts * constants.INITIAL_ORDERS_PER_DISTRICT + 0.45 * transactions / warehouses
+	newOrders = districts * constants.INITIAL_NEW_ORDERS_PER_DISTRICT + max(0.0, 0.45 - 0.04 * districts) * transactions / warehouses
+	remotePayments = min(0.43 * 0.15 * transactions / warehouses, customers * (warehouses - 1))
+	lines = (constants.MIN_OL_CNT + constants.MAX_OL_CNT) / 2.0
+	rows = {
+		constants.TABLENAME_WAREHOUSE: 1,
+		constants.TABLENAME_DISTRICT: districts,
+		constants.TABLENAME_CUSTOMER: customers,
+		constants.TABLENAME_STOCK: constants.STOCK_PER_WAREHOUSE,
+		constants.TABLENAME_ORDERS: orders,
+		constants.TABLENAME_NEW_ORDER: newOrders,
+		constants.TABLENAME_ORDER_LINE: orders * lines,
+		constants.TABLENAME_HISTORY: customers + remotePayments,
+	}
+
+	result = dict()
+	for sID, tables in servers.iteritems():
+		result[sID] = dict()
+		for tableName in tables.keys():
+			table = TableModel(tableName, tableName in orderedTables)
+			if tableName == constants.TABLENAME_ITEM:
+				for size in model.rowSizes(tableName):
+					table.add(constants.NUM_ITEMS, size)
+			else:
+				for size in model.rowSizes(tableName):
+					table.add(counts[sID] * rows[tableName], size)
+			## FOR
+			for records, size in model.lookups(tableName):
+				table.add(counts[sID] * records, size)
+			## FOR
+			result[sID][tableName] = table
+		## FOR
+	## FOR
+	return result
+
+## ==============================================
+## allocateMemory
+## ==============================================
+def allocateMemory(tables, memory):
+	"""Returns { tableName: xmsiz } sharing a server's memory budget, in
+	   bytes, between its tables. From the smallest table up, each one
+	   gets its whole file mapped or an equal share of what is left"""
+	xmsiz = dict()
+	sizes = sorted((t.fileSize(), tableName) for tableName, t in tables.iteritems())
+	for i, (size, tableName) in enumerate(sizes):
+		xmsiz[tableName] = min(size, memory / (len(sizes) - i))
+		memory -= xmsiz[tableName]
+	## FOR
+	return xmsiz
+
+## ==============================================
+## printPlan
+## ==============================================
+def printPlan(config, result, memory):
+	servers = eval(str(config["servers"]))
+	for sID in sorted(result.keys()):
+		tables = result[sID]
+		xmsiz = allocateMemory(tables, memory)
+		print "## Server %s: %.1f MB of data, %d MB of memory" % (sID,
+				sum(t.fileSize() for t in tables.values()) / float(1 << 20), memory >> 20)
+		for tableName in sorted(tables.keys()):
+			t = tables[tableName]
+			values = servers[sID][tableName]
+			print "# %s: %d records, %.1f MB" % (tableName, t.records, t.fileSize() / float(1 << 20))
+			print "ttserver -host %s -port %d -ext tokyocabinetdriver.lua '%s'" % (values["host"], values["port"], t.path(sID, xmsiz[tableName]))
+		## FOR
+		print
+	## FOR
+
+## ==============================================
+## checkServers
+## ==============================================
+def checkServers(config, result, defaultTuning):
+	"""Compares the record counts and sizes of the running servers with
+	   the plan. Their stats do not report the bucket count, so the
+	   records per bucket are computed with the planned bnum or, with
+	   defaultTuning, the one of databases opened without tuning
+	   parameters. Returns the number of tables that do not match"""
+	servers = eval(str(config["servers"]))
+	problems = 0
+	for sID in sorted(result.keys()):
+		for tableName in sorted(result[sID].keys()):
+			t = result[sID][tableName]
+			values = servers[sID][tableName]
+			stats = pyrant.Tyrant(values["host"], values["port"]).get_stats()
+			rnum, size = int(stats["rnum"]), int(stats["size"])
+			print "Server %s %s: %d records (planned %d), %.1f MB (planned %.1f MB)" % (sID, tableName,
+					rnum, t.records, size / float(1 << 20), t.fileSize() / float(1 << 20))
+
+			## B+tree databases hash their leaf pages, table databases
+			## their records
+			buckets = DEFAULT_BUCKETS[t.ordered] if defaultTuning else t.buckets()
+			entries = rnum if not t.ordered else int(math.ceil(float(rnum) / LEAF_MEMBERS))
+			if entries > MAX_RECORDS_PER_BUCKET * buckets:
+				logging.warn("Server %s %s: %d entries in %d buckets, use bnum=%d" % (sID, tableName,
+						entries, buckets, entries * BUCKETS_PER_RECORD))
+				problems += 1
+			if not (t.records / TOLERANCE <= rnum <= t.records * TOLERANCE):
+				logging.warn("Server %s %s: the record count is not the planned one" % (sID, tableName))
+				problems += 1
+			elif rnum > 0 and not (t.fileSize() / TOLERANCE <= size <= t.fileSize() * TOLERANCE):
+				logging.warn("Server %s %s: the records are %.0f bytes on average, not %.0f" % (sID, tableName,
+						float(size) / rnum, float(t.fileSize()) / max(1, t.records)))
+				problems += 1
+		## FOR
+	## FOR
+	return problems
+
+## ==============================================
+## makeServers
+## ==============================================
+def makeServers(layout, count, hosts):
+	"""Returns a servers configuration of count servers with the tables of
+	   layout, placed round-robin on hosts. Servers sharing a host get
+	   their own range of ports after the layout's"""
+	servers = dict()
+	for sID in xrange(count):
+		offset = (sID / len(hosts)) * len(layout)
+		servers[sID] = dict((tableName, { "host": hosts[sID % len(hosts)], "port": values["port"] + offset })
+				for tableName, values in layout.iteritems())
+	## FOR
+	return servers
+
+## ==============================================
+## main
+## ==============================================
+def main(argv):
+	parser = OptionParser(usage="%prog (--config=CONFIG | --servers=N [--hosts=H,...]) --warehouses=N [--memory=MB] [--transactions=N] [--check [--default-tuning]]")
+	parser.add_option("--config", help="Driver configuration with the servers to plan for")
+	parser.add_option("--servers", type="int", help="Number of servers, all with the default table layout, when there is no configuration")
+	parser.add_option("--warehouses", type="int", help="Number of warehouses of the database")
+	parser.add_option("--memory", type="int", default=1024, help="MB of memory each server may map for its tables")
+	parser.add_option("--transactions", type="int", default=0, help="Number of transactions the database must have room for")
+	parser.add_option("--hosts", help="Comma-separated hosts the --servers are spread over (default localhost)")
+	parser.add_option("--check", action="store_true", default=False, help="Compare the stats of the running servers with the plan")
+	parser.add_option("--default-tuning", action="store_true", default=False, help="With --check, the servers were started without tuning parameters")
+	parser.add_option("--debug", action="store_true", default=False, help="Enable debug log messages")
+	options, args = parser.parse_args(argv)
+	if not options.warehouses or not (options.config or options.servers):
+		parser.error("--warehouses and --config or --servers are required")
+	logging.basicConfig(level = logging.DEBUG if options.debug else logging.INFO,
+						format="%(asctime)s [%(funcName)s:%(lineno)03d] %(levelname)-5s: %(message)s")
+
+	if options.config:
+		config = readConfig(options.config)
+	else:
+		config = dict((key, value[1]) for key, value in TokyocabinetDriver.DEFAULT_CONFIG.iteritems())
+		hosts = options.hosts.split(",") if options.hosts else [ "localhost" ]
+		config["servers"] = repr(makeServers(eval(config["servers"])[0], options.servers, hosts))
+	## IF
+
+	result = plan(config, options.warehouses, options.transactions)
+	if options.check:
+		sys.exit(1 if checkServers(config, result, options.default_tuning) > 0 else 0)
+	printPlan(config, result, options.memory << 20)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])